@@ -1,18 +1,65 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from app.utils.idotmatrix import controller
+from app.utils.command_queue import DeviceCommandQueue
+from app.utils.device_pool import DevicePool
+from app.utils.fonts import font_registry
+from app.utils import graffiti
+from app.utils.search import SearchService
+from app.utils.downloader import downloader
+from app.utils.simulator import SimulatedAdapter
+from app.utils.metrics import metrics, start_trace, server_timing, TRACE_HEADER
+from concurrent.futures import CancelledError
+import asyncio
+import io
+import string
+import time
 import traceback
+import numpy as np
 
 app = FastAPI()
 
+# Every BLE command goes through this queue so only one thread ever talks to the panel
+device_queue = DeviceCommandQueue()
+# Further panels get their own controller and queue, see DevicePool
+pool = DevicePool(controller, device_queue)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    # With an X-IDM-Trace header the response carries the stage timings in Server-Timing
+    trace = start_trace() if request.headers.get(TRACE_HEADER) else None
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    path = route.path if route else "unmatched"
+    metrics.inc("idm_http_requests_total", route=path, status=response.status_code)
+    metrics.record("idm_http_request_seconds", elapsed, route=path)
+    if trace is not None:
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
+@app.on_event("startup")
+def start_background_work():
+    font_registry.preload()
+    controller.scanner.start()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    controller.converter.shutdown()
+    search_service.shutdown()
+
 @app.get("/")
 def read_root():
     return {"status": "ok", "service": "iDotMatrix Controller"}
@@ -31,8 +78,13 @@ def connect_device(data: dict):
     address = data.get("address")
     if not address:
         raise HTTPException(status_code=400, detail="Address is required")
+    # Optional: write_command slices in flight per write_request (IDM_STREAM_WINDOW by
+    # default), kept for later reconnects of the same panel
+    stream_window = data.get("stream_window")
+    if stream_window is not None and (type(stream_window) is not int or stream_window < 1):
+        raise HTTPException(status_code=400, detail="stream_window must be a positive integer")
     try:
-        success = controller.connect(address)
+        success = pool.connect(address, stream_window)
         return {"status": "connected", "success": success}
     except Exception as e:
         traceback.print_exc()
@@ -40,86 +92,228 @@ def connect_device(data: dict):
 
 
 @app.post("/disconnect")
-def disconnect_device():
+def disconnect_device(data: dict = None):
+    # Without a target every connected panel is disconnected
+    target = _resolve_target((data or {}).get("target"))
     try:
-        controller.disconnect()
-        return {"status": "disconnected"}
+        return {"status": "disconnected", "devices": pool.disconnect(target)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/status")
 def device_status():
     try:
-        return controller.get_connection_status()
+        devices = pool.status()
+        status = devices[0] if devices else controller.get_connection_status()
+        return dict(status, devices=devices)
     except Exception as e:
         # If any error, assume disconnected
         return {"connected": False}
 
+@app.get("/devices")
+def list_devices():
+    return {"devices": pool.status(), "groups": pool.groups, "walls": pool.walls}
+
+@app.put("/groups/{name}")
+def set_group(name: str, data: dict):
+    addresses = data.get("addresses")
+    if not isinstance(addresses, list) or not addresses:
+        raise HTTPException(status_code=400, detail="addresses must be a non-empty list")
+    return {"group": name, "addresses": pool.set_group(name, addresses)}
+
+@app.delete("/groups/{name}")
+def remove_group(name: str):
+    if not pool.remove_group(name):
+        raise HTTPException(status_code=404, detail="Group not found")
+    return {"status": "removed"}
+
+@app.put("/walls/{name}")
+def set_wall(name: str, data: dict):
+    # layout: rows of addresses, e.g. [["AA:..", "BB:.."], ["CC:..", "DD:.."]] for a 2x2 wall
+    try:
+        return {"wall": name, "layout": pool.set_wall(name, data.get("layout"))}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/walls/{name}")
+def remove_wall(name: str):
+    if not pool.remove_wall(name):
+        raise HTTPException(status_code=404, detail="Wall not found")
+    return {"status": "removed"}
+
+@app.get("/queue")
+def queue_status():
+    return dict(device_queue.stats(), devices=pool.queue_stats())
+
+@app.get("/cache")
+def cache_status():
+    return dict(controller.image_cache.stats(), downloads=downloader.stats())
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_text():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/simulator")
+def simulator_state():
+    # Only with IDM_SIMULATOR set: what every simulated panel received and shows
+    if not isinstance(controller.adapter, SimulatedAdapter):
+        raise HTTPException(status_code=404, detail="Not running with simulated panels")
+    return {"panels": controller.adapter.states()}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = pool.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+def _queued_response(job, wait, status, **extra):
+    # By default routes return as soon as the job is queued; wait=True keeps the
+    # old behaviour of answering after the panel has the data.
+    if not wait:
+        return {"status": "queued", "job_id": job.id, **extra}
+    try:
+        result = job.future.result()
+    except CancelledError:
+        # A newer display job replaced this one before it was sent
+        return {"status": "superseded", "job_id": job.id, **extra}
+    return {"status": status, "job_id": job.id, "transfer": result, **extra}
+
+def _resolve_target(target):
+    # target: an address, "group:<name>", "all" or a list of those; None means all
+    try:
+        return pool.resolve(target)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _fanout_response(jobs, wait, status, **extra):
+    # One panel keeps the single-job response; several get one entry per address
+    if len(jobs) == 1:
+        return _queued_response(jobs[0][1], wait, status, **extra)
+    devices = {}
+    for address, job in jobs:
+        try:
+            devices[address] = _queued_response(job, wait, status)
+        except Exception as e:
+            # One failing panel doesn't hide the results of the others
+            devices[address] = {"status": "failed", "job_id": job.id, "error": str(e)}
+    return {"status": status if wait else "queued", "devices": devices, **extra}
+
+def _palette_report(source, engine, payload):
+    # The global conversion cached the per-frame variant too, so this is a cache hit
+    baseline = controller.convert_payload(io.BytesIO(source), engine, "adaptive")
+    saved = len(baseline.data) - len(payload.data)
+    return {
+        "mode": "global",
+        "bytes": len(payload.data),
+        "adaptive_bytes": len(baseline.data),
+        "saved_bytes": saved,
+        "saved_percent": round(saved * 100 / len(baseline.data), 1) if baseline.data else 0,
+    }
+
+def _prefetch_conversion(source):
+    # Same parameters as a plain /fetch-url, so that request finds it in the cache
+    controller.convert_payload(io.BytesIO(source))
+
+search_service = SearchService(fetch=downloader.get, prefetch=_prefetch_conversion)
+
 @app.post("/fetch-url")
 def fetch_url_and_send(data: dict):
     url = data.get("url")
     if not url:
         raise HTTPException(status_code=400, detail="URL is required")
+    targets = _resolve_target(data.get("target"))
     
     try:
-        import requests
-        import io
-        
-        # Fake user agent to avoid some blockings
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
+        # A prefetched search result is served from the downloader's cache
+        content = downloader.get(url)
+        palette = data.get("palette", "adaptive")
+        budget = None
+        if data.get("max_bytes") or data.get("max_seconds"):
+            payload, budget = controller.convert_to_budget(io.BytesIO(content), data.get("max_bytes"), data.get("max_seconds"), engine=data.get("engine"))
+        else:
+            payload = controller.convert_payload(io.BytesIO(content), engine=data.get("engine"), palette=palette, delta=data.get("delta", False))
+        jobs = pool.submit(targets, "display", "send_image", payload.data, crc=payload.crc, force=data.get("force", False), coalesce=True)
         
-        content = response.content
-        img_bytes = controller.convert_image_to_32x32(io.BytesIO(content))
-        controller.send_image(img_bytes)
-        
-        return {"status": "uploaded_from_url"}
+        extra = {"size": len(payload.data)}
+        if budget:
+            extra["budget"] = budget
+        elif palette == "global" and not data.get("delta"):
+            extra["palette"] = _palette_report(content, data.get("engine"), payload)
+        return _fanout_response(jobs, data.get("wait", False), "uploaded_from_url", **extra)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to fetch or process URL: {str(e)}")
 
 @app.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(file: UploadFile = File(...), wait: bool = False, force: bool = False, engine: str = None, palette: str = "adaptive", delta: bool = False, max_bytes: int = None, max_seconds: float = None, target: str = None):
+    targets = _resolve_target(target)
+    try:
+        with metrics.span("upload.read"):
+            contents = await file.read()
+        # Conversion is CPU bound, keep it off the event loop
+        budget = None
+        if max_bytes or max_seconds:
+            payload, budget = await run_in_threadpool(controller.convert_to_budget, io.BytesIO(contents), max_bytes, max_seconds, engine)
+        else:
+            payload = await run_in_threadpool(controller.convert_payload, io.BytesIO(contents), engine, palette, delta)
+        img_bytes = payload.data
+        jobs = pool.submit(targets, "display", "send_image", img_bytes, crc=payload.crc, force=force, coalesce=True)
+        extra = {"size": len(img_bytes)}
+        if budget:
+            extra["budget"] = budget
+        elif palette == "global" and not delta:
+            extra["palette"] = await run_in_threadpool(_palette_report, contents, engine, payload)
+        if wait:
+            # The panels upload in parallel on their own workers, waiting costs one thread here
+            return await run_in_threadpool(_fanout_response, jobs, True, "uploaded", **extra)
+        return _fanout_response(jobs, False, "uploaded", **extra)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/walls/{name}/upload")
+async def upload_to_wall(name: str, file: UploadFile = File(...), wait: bool = False, force: bool = False, engine: str = None):
+    """
+    Shows one image across the panels of a wall: resized once to the whole wall,
+    split into 32x32 tiles, and uploaded to all panels at once with a synced start.
+    """
+    try:
+        layout = pool.wall(name)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         contents = await file.read()
-        import io
-        img_bytes = controller.convert_image_to_32x32(io.BytesIO(contents))
-        controller.send_image(img_bytes)
-        return {"status": "uploaded", "size": len(img_bytes)}
+        payloads = await run_in_threadpool(controller.convert_wall, io.BytesIO(contents), len(layout[0]), len(layout), engine)
+        jobs = pool.submit_wall(layout, payloads, force=force)
+        extra = {"wall": name, "size": sum(len(p.data) for p in payloads)}
+        if wait:
+            return await run_in_threadpool(_fanout_response, jobs, True, "uploaded", **extra)
+        return _fanout_response(jobs, False, "uploaded", **extra)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- New Modules ---
 
-from duckduckgo_search import DDGS
-
 @app.get("/search")
 async def search_images(q: str):
     """
     Search for images using DuckDuckGo (no API key required).
+    Results are cached per query and the top hits are pre-converted in the background.
     """
-    results = []
-    try:
-        search_query = f"{q} pixel art"
-        with DDGS() as ddgs:
-            # Get up to 50 results
-            ddgs_images = list(ddgs.images(
-                search_query, 
-                max_results=50,
-                type_image="gif"
-            ))
-            for img in ddgs_images:
-                results.append({
-                    "title": img.get("title", ""),
-                    "url": img.get("image", ""),
-                    "thumbnail": img.get("thumbnail", "")
-                })
+    try:
+        # Shielded: the Future may be shared with other requests for the same
+        # query, a client going away must not cancel it for all of them
+        return await asyncio.shield(asyncio.wrap_future(search_service.submit(q)))
     except Exception as e:
         print(f"Search error: {e}")
         return []
-    return results
+
+@app.get("/search/stats")
+def search_stats():
+    return search_service.stats()
 
 @app.post("/text")
 def send_text(data: dict):
@@ -132,31 +326,158 @@ def send_text(data: dict):
         raise HTTPException(status_code=400, detail="Text is required")
         
     # Convert Hex to RGB
-    color_hex = color_hex.lstrip('#')
+    color_hex = str(color_hex).lstrip('#')
+    if len(color_hex) != 6 or any(c not in string.hexdigits for c in color_hex):
+        raise HTTPException(status_code=400, detail="color must be #RRGGBB")
     rgb = tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
+    # Both go into the text packet as single bytes
+    mode = data.get("mode", 1)
+    speed = data.get("speed", 95)
+    for name, value in (("mode", mode), ("speed", speed)):
+        if type(value) is not int or not 0 <= value <= 255:
+            raise HTTPException(status_code=400, detail=f"{name} must be an integer from 0 to 255")
     
+    targets = _resolve_target(data.get("target"))
+    try:
+        if data.get("engine", "native") == "native":
+            # The panel scrolls the text itself, we only send one bitmap per character
+            jobs = pool.submit(
+                targets, "display", "send_text", text,
+                text_mode=mode,
+                speed=speed,
+                text_colour=rgb,
+                force=data.get("force", False),
+                coalesce=True,
+            )
+        else:
+            with metrics.span("text.render"):
+                gif_bytes = create_scrolling_text_gif(text, rgb, delta=data.get("delta", False))
+            jobs = pool.submit(targets, "display", "send_image", gif_bytes, force=data.get("force", False), coalesce=True)
+        return _fanout_response(jobs, data.get("wait", False), "text_sent")
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/graffiti")
+def paint_graffiti(data: dict):
+    """
+    Expects {"grid": 32 rows of 32 "#RRGGBB" strings}. Only the pixels that differ
+    from what the panel shows are sent, see IDotMatrix.paint_frame.
+    """
     try:
-        gif_bytes = create_scrolling_text_gif(text, rgb)
-        controller.send_image(gif_bytes)
-        return {"status": "text_sent"}
+        frame = graffiti.to_framebuffer(data.get("grid") or [])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid grid: {e}")
+    targets = _resolve_target(data.get("target"))
+    try:
+        # A newer drawing replaces one still waiting; the diff is taken when the job runs,
+        # against each panel's own framebuffer
+        jobs = pool.submit(targets, "display", "paint_frame", frame, force=data.get("force", False), coalesce=True)
+        return _fanout_response(jobs, data.get("wait", False), "painted")
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.websocket("/ws/frames")
+async def live_frames(websocket: WebSocket, target: str = None):
+    """
+    Live drawing. Binary messages are either a whole frame (3072 bytes of RGB, rows
+    top to bottom) or 5-byte (x, y, r, g, b) pixel deltas on top of the frames so
+    far. Only the newest frame is kept: anything that arrives while the panel is
+    busy replaces what is waiting, so the panel is never more than one frame behind.
+    Every frame that reaches the panel is acknowledged with {"seq", "latency_ms",
+    "dropped", "transfer"}; seq counts messages from 1 and latency_ms runs from the
+    oldest message merged into the frame. ?target= picks the panels, all by default;
+    with several panels a frame is acknowledged once all of them show it.
+    On connect the server sends the frame deltas apply to, 3072 bytes of RGB
+    (black when it does not know what the panel shows). Text messages are
+    answered with an error and otherwise ignored.
+    """
+    await websocket.accept()
+    try:
+        first = pool.panel(pool.resolve(target)[0])
+    except Exception as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    canvas = first.framebuffer.copy() if first.framebuffer is not None else np.zeros((32, 32, 3), dtype=np.uint8)
+    await websocket.send_bytes(canvas.tobytes())
+    pending = {}
+    frame_ready = asyncio.Event()
+
+    async def receive():
+        seq = 0
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is None:
+                await websocket.send_json({"error": "Expected a binary message"})
+                continue
+            message = message["bytes"]
+            seq += 1
+            try:
+                graffiti.apply_message(canvas, message)
+            except Exception as e:
+                await websocket.send_json({"seq": seq, "error": str(e)})
+                continue
+            if pending:
+                pending.update(seq=seq, frame=canvas.copy(), dropped=pending["dropped"] + 1)
+            else:
+                pending.update(seq=seq, frame=canvas.copy(), received=time.perf_counter(), dropped=0)
+            frame_ready.set()
+
+    async def send():
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            latest = dict(pending)
+            pending.clear()
+            jobs = []
+            try:
+                jobs = pool.submit(pool.resolve(target), "display", "paint_frame", latest["frame"], coalesce=True)
+                results = await asyncio.gather(*[asyncio.wrap_future(job.future) for _, job in jobs])
+            except asyncio.CancelledError:
+                if not any(job.status == "superseded" for _, job in jobs):
+                    raise
+                # An HTTP display job took over the panel, the next message repaints
+                continue
+            except Exception as e:
+                await websocket.send_json({"seq": latest["seq"], "error": str(e)})
+                continue
+            await websocket.send_json({
+                "seq": latest["seq"],
+                "latency_ms": round((time.perf_counter() - latest["received"]) * 1000, 1),
+                "dropped": latest["dropped"],
+                "transfer": results[0] if len(results) == 1 else dict(zip([a for a, _ in jobs], results)),
+            })
+
+    receiver = asyncio.create_task(receive())
+    sender = asyncio.create_task(send())
+    try:
+        done, _ = await asyncio.wait([receiver, sender], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                raise task.exception()
+    finally:
+        receiver.cancel()
+        sender.cancel()
+
 @app.post("/sync-time")
-def sync_device_time():
+def sync_device_time(wait: bool = False, target: str = None):
+    targets = _resolve_target(target)
     try:
-        controller.sync_time()
-        return {"status": "time_synced"}
+        jobs = pool.submit(targets, "sync_time", "sync_time")
+        return _fanout_response(jobs, wait, "time_synced")
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/clock-mode")
-def set_clock_mode():
+def set_clock_mode(wait: bool = False, target: str = None):
+    targets = _resolve_target(target)
     try:
-        controller.set_mode_clock()
-        return {"status": "mode_set_to_clock"}
+        jobs = pool.submit(targets, "display", "set_mode_clock", coalesce=True)
+        return _fanout_response(jobs, wait, "mode_set_to_clock")
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,129 @@
+import contextvars
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from app.utils.metrics import metrics
+
+JOB_HISTORY = 200 # Finished jobs kept around for /jobs/{id} lookups
+
+class Job:
+    def __init__(self, kind, func, args, kwargs, coalesce):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.status = "queued"
+        self.error = None
+        self.future = Future()
+        # Jobs run in the context they were submitted from, so a traced request sees their stages
+        self.context = contextvars.copy_context()
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        wait = (self.started_at or self.finished_at or time.time()) - self.created_at
+        run = (self.finished_at - self.started_at) if self.started_at and self.finished_at else None
+        result = self.future.result() if self.status == "done" else None
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "result": result if isinstance(result, (dict, list, str, int, float, bool)) else None,
+            "queue_wait_ms": round(wait * 1000, 1),
+            "run_ms": round(run * 1000, 1) if run is not None else None,
+        }
+
+class DeviceCommandQueue:
+    """
+    Serializes every command for one panel on a single BLE worker thread.
+
+    Routes submit work and get a Job back straight away. When a job is submitted
+    with coalesce=True, any still-queued job of the same kind is superseded, so a
+    burst of image uploads only ever sends the newest frame.
+    """
+
+    def __init__(self, name="ble-worker"):
+        self._pending = deque()
+        self._jobs = OrderedDict()
+        self._cond = threading.Condition()
+        self._current = None
+        self._processed = 0
+        self._failed = 0
+        self._superseded = 0
+        self._total_wait = 0.0
+        self._total_run = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, func, *args, coalesce=False, **kwargs):
+        job = Job(kind, func, args, kwargs, coalesce)
+        with self._cond:
+            if coalesce:
+                for old in [j for j in self._pending if j.kind == kind]:
+                    self._pending.remove(old)
+                    old.status = "superseded"
+                    old.finished_at = time.time()
+                    old.future.cancel()
+                    self._superseded += 1
+            self._pending.append(job)
+            self._jobs[job.id] = job
+            while len(self._jobs) > JOB_HISTORY:
+                self._jobs.popitem(last=False)
+            self._cond.notify()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._cond:
+            finished = self._processed + self._failed
+            return {
+                "depth": len(self._pending),
+                "running": self._current.id if self._current else None,
+                "processed": self._processed,
+                "failed": self._failed,
+                "superseded": self._superseded,
+                "avg_queue_wait_ms": round(self._total_wait / finished * 1000, 1) if finished else None,
+                "avg_run_ms": round(self._total_run / finished * 1000, 1) if finished else None,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                job.status = "running"
+                job.started_at = time.time()
+                job.future.set_running_or_notify_cancel()
+                self._current = job
+            job.context.run(metrics.observe, "queue.wait", job.started_at - job.created_at)
+            try:
+                result = job.context.run(job.func, *job.args, **job.kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.future.set_exception(e)
+                job.status = "failed"
+            else:
+                job.finished_at = time.time()
+                job.future.set_result(result)
+                job.status = "done"
+            with self._cond:
+                self._current = None
+                if job.status == "done":
+                    self._processed += 1
+                else:
+                    self._failed += 1
+                self._total_wait += job.started_at - job.created_at
+                self._total_run += job.finished_at - job.started_at
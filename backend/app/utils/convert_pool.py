@@ -0,0 +1,179 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+from app.utils import image_convert, numpy_engine, gif_delta, gif_budget
+from app.utils.metrics import metrics
+
+CONVERT_WORKERS = int(os.environ.get("IDM_CONVERT_WORKERS", os.cpu_count() or 1))
+CONVERT_TIMEOUT = float(os.environ.get("IDM_CONVERT_TIMEOUT", 30))
+# Animations longer than this are split across workers
+FRAMES_PER_TASK = 32
+
+# Frame preprocessing engines; both return (frames, durations, animated) for a frame range
+ENGINES = {
+    "pillow": image_convert.render_frames,
+    "numpy": numpy_engine.render_frames,
+}
+
+class ConversionPipeline:
+    """
+    Runs image conversion in a ProcessPoolExecutor so Pillow never competes with
+    the web server or the BLE worker for the GIL.
+
+    Long animations are split into frame ranges, converted in parallel and put back
+    together in order before the GIF is encoded. Each worker seeks to the start of
+    its range itself, since GIF frames can only be decoded in sequence; the
+    expensive resize and quantize steps are what gets spread out.
+    workers=0 converts inline in the calling thread. A conversion that runs
+    longer than timeout raises TimeoutError and its workers are killed, so an
+    oversized input cannot keep the pool busy after the request has failed.
+
+    Workers are spawned, not forked: by the time the first conversion starts the
+    server runs the BLE worker, the scanner and the event loop, and forking a
+    process with threads can leave a lock held forever in the child.
+    """
+
+    def __init__(self, workers=CONVERT_WORKERS, timeout=CONVERT_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _reset_executor(self, executor=None, terminate=False):
+        # executor: only reset if the pool is still this one, a conversion that
+        # failed on an old pool must not take down its replacement.
+        # terminate=True also kills the workers, cancel() cannot stop a task that
+        # already runs and a timed-out conversion would keep its worker busy.
+        with self._lock:
+            if self._executor is None or executor not in (None, self._executor):
+                return
+            executor, self._executor = self._executor, None
+        processes = list((executor._processes or {}).values()) if terminate else []
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _frame_ranges(self, n_frames):
+        if n_frames <= FRAMES_PER_TASK:
+            return [(0, None)]
+        per_task = max(FRAMES_PER_TASK, -(-n_frames // self.workers))
+        return [(start, start + per_task) for start in range(0, n_frames, per_task)]
+
+    def _render(self, source_bytes, engine, quantize=True, size=image_convert.PANEL_SIZE):
+        # Decode, resize and quantize run together frame by frame in the workers, timed as one stage
+        with metrics.span("convert.render"):
+            return self._render_frames(source_bytes, engine, quantize, size)
+
+    def _render_frames(self, source_bytes, engine, quantize, size):
+        render_frames = ENGINES[engine]
+        if self.workers <= 0:
+            return render_frames(source_bytes, quantize=quantize, size=size)
+
+        executor = self._get_executor()
+        n_frames = image_convert.frame_count(source_bytes)
+        futures = [
+            executor.submit(render_frames, source_bytes, start, stop, quantize, size)
+            for start, stop in self._frame_ranges(n_frames)
+        ]
+        done, not_done = wait(futures, timeout=self.timeout)
+        if not_done:
+            # Other conversions running on this pool fail along with it
+            self._reset_executor(executor, terminate=True)
+            raise TimeoutError(f"Image conversion took longer than {self.timeout}s")
+
+        frames = []
+        durations = []
+        animated = False
+        try:
+            for f in futures:
+                part_frames, part_durations, animated = f.result()
+                frames.extend(part_frames)
+                durations.extend(part_durations)
+        except BrokenProcessPool:
+            # A worker died (out of memory, killed); start a fresh pool next time
+            self._reset_executor(executor)
+            raise
+        return frames, durations, animated
+
+    def convert(self, source_bytes, engine="pillow", palette="adaptive", delta=False):
+        """
+        palette="adaptive" quantizes every frame on its own (one local colour table
+        per frame); palette="global" shares one palette across the animation.
+        delta=True merges duplicate frames and stores only changed regions
+        (see gif_delta), which implies a global palette.
+        """
+        if delta:
+            frames, durations, animated = self._render(source_bytes, engine, quantize=False)
+            with metrics.span("convert.encode"):
+                if animated:
+                    return gif_delta.encode_delta_gif(frames, durations)
+                return image_convert.encode_gif(frames, durations, animated)
+        if palette == "global":
+            return self.convert_palette_variants(source_bytes, engine)["global"]
+        rendered = self._render(source_bytes, engine)
+        with metrics.span("convert.encode"):
+            return image_convert.encode_gif(*rendered)
+
+    def convert_to_budget(self, source_bytes, max_bytes, engine="pillow"):
+        """
+        Returns (gif_bytes, settings) for the least lossy settings that fit in
+        max_bytes, see gif_budget.fit_to_budget.
+        """
+        frames, durations, animated = self._render(source_bytes, engine, quantize=False)
+        if not animated:
+            data = image_convert.encode_gif(frames, durations, animated)
+            return data, {"frames": 1, "bytes": len(data), "max_bytes": max_bytes, "fits": len(data) <= max_bytes}
+        return gif_budget.fit_to_budget(frames, durations, max_bytes)
+
+    def convert_palette_variants(self, source_bytes, engine="pillow"):
+        """
+        Encodes the animation with both palette modes from a single render pass.
+        Returns {"global": bytes, "adaptive": bytes}.
+        """
+        frames, durations, animated = self._render(source_bytes, engine, quantize=False)
+        if not animated:
+            data = image_convert.encode_gif(frames, durations, animated)
+            return {"global": data, "adaptive": data}
+        with metrics.span("convert.encode"):
+            palette_image = image_convert.build_global_palette(frames)
+            return {
+                "global": image_convert.encode_gif(image_convert.remap_frames(frames, palette_image), durations, animated, palette_image),
+                "adaptive": image_convert.encode_gif([image_convert.quantize_frame(f) for f in frames], durations, animated),
+            }
+
+    def convert_wall(self, source_bytes, cols, rows, engine="pillow"):
+        """
+        Resizes the source once to the size of the whole wall, (32*cols)x(32*rows),
+        and cuts it into one 32x32 GIF per panel, row by row. The tiles are
+        quantized and encoded in parallel.
+        """
+        width, height = image_convert.PANEL_SIZE
+        frames, durations, animated = self._render(source_bytes, engine, quantize=False, size=(width * cols, height * rows))
+        tiles = image_convert.slice_tiles(frames, cols, rows)
+        if self.workers <= 0:
+            return [image_convert.encode_tile(tile, durations, animated) for tile in tiles]
+
+        executor = self._get_executor()
+        futures = [executor.submit(image_convert.encode_tile, tile, durations, animated) for tile in tiles]
+        done, not_done = wait(futures, timeout=self.timeout)
+        if not_done:
+            self._reset_executor(executor, terminate=True)
+            raise TimeoutError(f"Tile encoding took longer than {self.timeout}s")
+        try:
+            return [f.result() for f in futures]
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            raise
+
+    def shutdown(self):
+        self._reset_executor()
+
+conversion_pipeline = ConversionPipeline()
@@ -0,0 +1,193 @@
+import threading
+from app.utils.idotmatrix import IDotMatrix
+from app.utils.command_queue import DeviceCommandQueue
+
+class DevicePool:
+    """
+    Every connected panel keyed by address, each with its own IDotMatrix and its
+    own DeviceCommandQueue worker, so uploads to different panels run in parallel.
+
+    The first panel to connect uses the app's primary controller and queue, so a
+    single-panel setup behaves exactly as before. Further panels get their own
+    IDotMatrix sharing the primary's adapter and background scanner.
+
+    A target is None or "all", an address, "group:<name>", or a comma separated
+    (or list) mix of those.
+
+    A wall is a named grid of addresses (rows of columns) that shows one image
+    split across its panels, see submit_wall. None in the grid leaves a gap.
+    """
+
+    def __init__(self, primary, primary_queue):
+        self.primary = primary
+        self.primary_queue = primary_queue
+        self._panels = {} # address -> (IDotMatrix, DeviceCommandQueue)
+        self._workers = {} # address -> DeviceCommandQueue, kept for reconnects
+        self.groups = {}
+        self.walls = {}
+        self._lock = threading.Lock()
+
+    def connect(self, address, stream_window=None):
+        with self._lock:
+            if address in self._panels:
+                panel, queue = self._panels[address]
+            elif not any(p is self.primary for p, _ in self._panels.values()):
+                panel, queue = self.primary, self.primary_queue
+            else:
+                panel = IDotMatrix(adapter=self.primary.adapter, scanner=self.primary.scanner)
+                if address not in self._workers:
+                    self._workers[address] = DeviceCommandQueue(name=f"ble-{address}")
+                queue = self._workers[address]
+            # Reserve the slot so a concurrent connect doesn't take the same controller
+            self._panels[address] = (panel, queue)
+            if stream_window is not None:
+                # Read when the transport is set up, so it takes effect with this connect
+                panel.stream_window = stream_window
+        try:
+            return queue.submit("connect", panel.connect, address).future.result()
+        except Exception:
+            with self._lock:
+                if not panel.is_connected:
+                    self._panels.pop(address, None)
+            raise
+
+    def disconnect(self, target=None):
+        addresses = self.resolve(target)
+        jobs = [(address, self.queue(address).submit("disconnect", self.panel(address).disconnect)) for address in addresses]
+        for address, job in jobs:
+            job.future.result()
+            with self._lock:
+                self._panels.pop(address, None)
+        return [address for address, _ in jobs]
+
+    def resolve(self, target=None):
+        """
+        Returns the addresses a target refers to. With nothing connected the
+        primary controller stands in (address None), so commands fail the same
+        way they always did.
+        """
+        with self._lock:
+            connected = list(self._panels)
+            groups = {name: list(members) for name, members in self.groups.items()}
+        if target is None or target == "all":
+            return connected or [None]
+        items = target.split(",") if isinstance(target, str) else list(target)
+        addresses = []
+        for item in (i.strip() for i in items):
+            if item == "all":
+                members = connected
+            elif item.startswith("group:"):
+                if item[6:] not in groups:
+                    raise Exception(f"Unknown group: {item[6:]}")
+                members = [a for a in groups[item[6:]] if a in connected]
+            elif item in connected:
+                members = [item]
+            else:
+                raise Exception(f"Device {item} is not connected")
+            addresses.extend(a for a in members if a not in addresses)
+        return addresses
+
+    def panel(self, address):
+        if address is None:
+            return self.primary
+        return self._panels[address][0]
+
+    def queue(self, address):
+        if address is None:
+            return self.primary_queue
+        return self._panels[address][1]
+
+    def submit(self, addresses, kind, method, *args, coalesce=False, **kwargs):
+        """
+        Queues panel.<method>(*args, **kwargs) on every panel in addresses (see
+        resolve) at once. Arguments are shared, so a payload is converted once and
+        only the BLE transfers are repeated, each on its own worker.
+        Returns a list of (address, Job).
+        """
+        return [
+            (address, self.queue(address).submit(kind, getattr(self.panel(address), method), *args, coalesce=coalesce, **kwargs))
+            for address in addresses
+        ]
+
+    def get_job(self, job_id):
+        for queue in self._queues():
+            job = queue.get(job_id)
+            if job:
+                return job
+        return None
+
+    def set_group(self, name, addresses):
+        with self._lock:
+            self.groups[name] = list(dict.fromkeys(addresses))
+            return self.groups[name]
+
+    def remove_group(self, name):
+        with self._lock:
+            return self.groups.pop(name, None) is not None
+
+    def set_wall(self, name, layout):
+        if not layout or not all(isinstance(row, list) and row for row in layout):
+            raise Exception("A wall layout is a non-empty list of rows of addresses")
+        if len({len(row) for row in layout}) != 1:
+            raise Exception("Every row of a wall needs the same number of panels")
+        addresses = [a for row in layout for a in row if a]
+        if len(addresses) != len(set(addresses)):
+            raise Exception("A panel can only appear once in a wall")
+        with self._lock:
+            self.walls[name] = [list(row) for row in layout]
+            return self.walls[name]
+
+    def remove_wall(self, name):
+        with self._lock:
+            return self.walls.pop(name, None) is not None
+
+    def wall(self, name):
+        """
+        Returns the layout of a wall after checking all of its panels are connected.
+        """
+        with self._lock:
+            layout = self.walls.get(name)
+            connected = set(self._panels)
+        if layout is None:
+            raise Exception(f"Unknown wall: {name}")
+        missing = [a for row in layout for a in row if a and a not in connected]
+        if missing:
+            raise Exception(f"Wall {name} has panels that are not connected: {', '.join(missing)}")
+        return layout
+
+    def submit_wall(self, layout, payloads, force=False):
+        """
+        Queues one tile per panel (payloads row by row, as from
+        IDotMatrix.convert_wall) on every panel's worker at once. The uploads share
+        a barrier that holds back each panel's last chunk until all of them are
+        ready, so the tiles start animating together.
+        Returns a list of (address, Job).
+        """
+        cells = [(address, payload) for address, payload in zip((a for row in layout for a in row), payloads) if address]
+        barrier = threading.Barrier(len(cells))
+
+        def release(future):
+            # A tile that is superseded or fails never reaches the barrier, don't keep the others waiting
+            if future.cancelled() or future.exception() is not None:
+                barrier.abort()
+
+        jobs = []
+        for address, payload in cells:
+            job = self.queue(address).submit("display", self.panel(address).send_image, payload.data, crc=payload.crc, force=force, barrier=barrier, coalesce=True)
+            job.future.add_done_callback(release)
+            jobs.append((address, job))
+        return jobs
+
+    def status(self):
+        with self._lock:
+            panels = [panel for panel, _ in self._panels.values()]
+        return [p.get_connection_status() for p in panels if p.is_connected]
+
+    def queue_stats(self):
+        with self._lock:
+            queues = {address: queue for address, (_, queue) in self._panels.items()}
+        return {address: queue.stats() for address, queue in queues.items()}
+
+    def _queues(self):
+        with self._lock:
+            return [self.primary_queue] + list(self._workers.values())
@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+import requests
+from requests.adapters import HTTPAdapter
+from app.utils.metrics import metrics
+
+MAX_DOWNLOAD_BYTES = int(os.environ.get("IDM_MAX_DOWNLOAD_BYTES", 20 * 1024 * 1024))
+DOWNLOAD_TIMEOUT = 10
+READ_CHUNK = 64 * 1024
+SNIFF_BYTES = 16
+POOL_SIZE = 8
+CACHE_LIMIT = 64 * 1024 * 1024 # bytes of downloaded images kept for revalidation
+
+# Leading bytes of the formats Pillow is asked to open here
+IMAGE_SIGNATURES = (
+    b"GIF87a", b"GIF89a",
+    b"\x89PNG\r\n\x1a\n",
+    b"\xff\xd8\xff", # JPEG
+    b"RIFF", # WebP, checked further in is_image
+    b"BM",
+    b"\x00\x00\x01\x00", # ICO
+)
+
+CachedDownload = namedtuple("CachedDownload", ["content", "etag", "last_modified"])
+
+def is_image(head, content_type=""):
+    """
+    True when the first bytes of a body look like an image. Formats we have no
+    signature for pass when the server says image/*.
+    """
+    if head.startswith(b"RIFF"):
+        return head[8:12] == b"WEBP"
+    if head.startswith(IMAGE_SIGNATURES):
+        return True
+    return content_type.startswith("image/")
+
+class Downloader:
+    """
+    Fetches images over one pooled requests.Session.
+
+    Bodies are streamed and the download is aborted as soon as it passes
+    max_bytes, or when the first bytes do not look like an image (an HTML error
+    page, a video). Responses with an ETag or Last-Modified are kept in a bounded
+    LRU and revalidated with If-None-Match / If-Modified-Since, so fetching the
+    same URL again is a 304 with no body.
+    """
+
+    def __init__(self, max_bytes=MAX_DOWNLOAD_BYTES, timeout=DOWNLOAD_TIMEOUT, cache_limit=CACHE_LIMIT):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache_limit = cache_limit
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Fake user agent to avoid some blockings
+        self.session.headers["User-Agent"] = "Mozilla/5.0"
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.revalidated = 0
+        self.rejected = 0
+        self.bytes_read = 0
+
+    def get(self, url):
+        with metrics.span("download"):
+            return self._get(url)
+
+    def _get(self, url):
+        with self._lock:
+            cached = self._cache.get(url)
+        headers = {}
+        if cached:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304 and cached:
+                with self._lock:
+                    self._cache.move_to_end(url)
+                    self.revalidated += 1
+                return cached.content
+            response.raise_for_status()
+            content = self._read(response)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self._lock:
+            self.downloads += 1
+            self._drop(url)
+            if (etag or last_modified) and len(content) <= self.cache_limit:
+                self._cache[url] = CachedDownload(content, etag, last_modified)
+                self._cache_bytes += len(content)
+                while self._cache_bytes > self.cache_limit:
+                    self._drop(next(iter(self._cache)))
+        return content
+
+    def _read(self, response):
+        content_type = response.headers.get("Content-Type", "").lower()
+        declared = response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > self.max_bytes:
+            self._reject()
+            raise Exception(f"Image is {int(declared)} bytes, the limit is {self.max_bytes}")
+        body = bytearray()
+        sniffed = False
+        for chunk in response.iter_content(READ_CHUNK):
+            body += chunk
+            if not sniffed and len(body) >= SNIFF_BYTES:
+                self._check_image(body, content_type)
+                sniffed = True
+            if len(body) > self.max_bytes:
+                # Content-Length can be missing or wrong, the limit holds either way
+                self._reject()
+                raise Exception(f"Image is larger than {self.max_bytes} bytes")
+        if not sniffed:
+            self._check_image(body, content_type)
+        metrics.inc("idm_download_bytes_total", len(body))
+        with self._lock:
+            self.bytes_read += len(body)
+        return bytes(body)
+
+    def _check_image(self, body, content_type):
+        if not is_image(bytes(body[:SNIFF_BYTES]), content_type):
+            self._reject()
+            raise Exception(f"Not an image (Content-Type: {content_type or 'unknown'})")
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def _drop(self, url):
+        old = self._cache.pop(url, None)
+        if old is not None:
+            self._cache_bytes -= len(old.content)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "revalidated": self.revalidated,
+                "rejected": self.rejected,
+                "bytes_read": self.bytes_read,
+                "cached_urls": len(self._cache),
+                "cached_bytes": self._cache_bytes,
+            }
+
+downloader = Downloader()
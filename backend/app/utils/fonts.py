@@ -0,0 +1,129 @@
+from PIL import Image, ImageDraw, ImageFont
+import threading
+from collections import OrderedDict
+
+# Font candidates per use, tried in order. The native text glyphs are 1-bit so a
+# bold face reads best; the scrolling GIF keeps the font it always used.
+FONT_CANDIDATES = {
+    "glyph": [
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+        "DejaVuSans-Bold.ttf",
+        "arialbd.ttf",
+        "Arial Bold.ttf",
+    ],
+    "scroll": ["arial.ttf"],
+}
+GLYPH_FONT_SIZE = 24
+SCROLL_FONT_SIZE = 24
+GLYPH_WIDTH, GLYPH_HEIGHT = 16, 32
+GLYPH_MARKER = bytes.fromhex("05ffffff") # 05 is the font size (32) and ffffff is fixed
+GLYPH_CACHE_SIZE = 4096
+
+# Pillow packs 1-bit rows with the leftmost pixel in the highest bit, the panel
+# wants it in the lowest bit. Translating through this table flips every byte.
+REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def line_top(font, height=GLYPH_HEIGHT):
+    """
+    Row to draw the ascender line at so the font's whole line (ascent + descent)
+    is centred in a cell of the given height. It depends only on the font, so
+    every character drawn there sits on the same baseline.
+    """
+    try:
+        ascent, descent = font.getmetrics()
+    except AttributeError:
+        # Pillow's old built-in bitmap font has no metrics
+        ascent, descent = font.getbbox("Ag")[3], 0
+    return (height - (ascent + descent)) // 2
+
+class FontRegistry:
+    """
+    Loads every (font, size) pair once and hands out the same FreeTypeFont after.
+    A font is either a key of FONT_CANDIDATES or a path to a font file; when none
+    of the candidates can be opened Pillow's built-in bitmap font is used.
+    """
+
+    def __init__(self, candidates=FONT_CANDIDATES):
+        self.candidates = candidates
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def get(self, font, size):
+        key = (font, size)
+        loaded = self._fonts.get(key)
+        if loaded is not None:
+            return loaded
+        with self._lock:
+            if key not in self._fonts:
+                self._fonts[key] = self._load(font, size)
+            return self._fonts[key]
+
+    def _load(self, font, size):
+        for path in self.candidates.get(font, [font]):
+            try:
+                return ImageFont.truetype(path, size)
+            except IOError:
+                continue
+        print(f"Font {font} not found, using the default bitmap font")
+        return ImageFont.load_default()
+
+    def preload(self):
+        self.get("glyph", GLYPH_FONT_SIZE)
+        self.get("scroll", SCROLL_FONT_SIZE)
+
+class GlyphCache:
+    """
+    LRU cache of rendered characters for the native text command, keyed by
+    (font, size, char). Every entry is the 05ffffff marker followed by the 16x32
+    bitmap as 64 bytes, rows top to bottom, leftmost pixel in the lowest bit, so
+    a text payload is just a join of cached entries.
+    """
+
+    def __init__(self, registry, max_entries=GLYPH_CACHE_SIZE):
+        self.registry = registry
+        self.max_entries = max_entries
+        self._glyphs = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def glyph(self, char, font="glyph", size=GLYPH_FONT_SIZE):
+        key = (font, size, char)
+        with self._lock:
+            data = self._glyphs.get(key)
+            if data is not None:
+                self._glyphs.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+            # FreeType faces are not safe to share between threads, render under the lock
+            data = self._render(char, self.registry.get(font, size))
+            self._glyphs[key] = data
+            if len(self._glyphs) > self.max_entries:
+                self._glyphs.popitem(last=False)
+            return data
+
+    @staticmethod
+    def _render(char, font):
+        image = Image.new('1', (GLYPH_WIDTH, GLYPH_HEIGHT), 0)
+        draw = ImageDraw.Draw(image)
+        # Centred on its ink horizontally, but vertically on the font's line, so
+        # "a", "g" and "." keep a common baseline
+        left, _, right, _ = draw.textbbox((0, 0), char, font=font)
+        text_x = (GLYPH_WIDTH - (right - left)) // 2 - left
+        draw.text((text_x, line_top(font)), char, 1, font=font)
+        return GLYPH_MARKER + image.tobytes().translate(REVERSE_BITS)
+
+    def render(self, text, font="glyph", size=GLYPH_FONT_SIZE):
+        return b"".join([self.glyph(char, font, size) for char in text])
+
+    def clear(self):
+        with self._lock:
+            self._glyphs.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._glyphs)}
+
+font_registry = FontRegistry()
+glyph_cache = GlyphCache(font_registry)
@@ -0,0 +1,85 @@
+import numpy as np
+from app.utils.gif_delta import encode_delta_gif, append_frame
+from app.utils.image_convert import PALETTE_COLORS
+
+# Settings tried in order until the GIF fits: first shrink the palette, then
+# decimate, and only then drop frames that barely change, since small sprite
+# animations (a flickering flame) change few pixels per frame and would
+# otherwise collapse into a still image.
+# Each step is (change_threshold, keep_every, colors); change_threshold is the
+# fraction of pixels that must change for a frame to be kept.
+BUDGET_LADDER = [
+    (0, 1, PALETTE_COLORS),
+    (0, 1, 128),
+    (0, 1, 64),
+    (0, 2, 64),
+    (0, 3, 64),
+    (0, 4, 32),
+    (0.005, 4, 32),
+    (0.01, 6, 32),
+    (0.02, 8, 16),
+    (0.05, 12, 8),
+]
+# A pixel counts as changed when one of its channels moved by more than this
+CHANGE_TOLERANCE = 16
+
+def changed_fraction(previous, current):
+    return (np.abs(current - previous).max(axis=2) > CHANGE_TOLERANCE).mean()
+
+def drop_static_frames(frames, durations, threshold):
+    """
+    Merges frames where less than threshold of the pixels changed since the last
+    kept frame into that frame, so the animation keeps its overall playback time.
+    """
+    if threshold <= 0:
+        return list(frames), list(durations)
+    kept = []
+    kept_durations = []
+    reference = None
+    for frame, duration in zip(frames, durations):
+        current = np.asarray(frame, dtype=np.int16)
+        static = reference is not None and changed_fraction(reference, current) < threshold
+        append_frame(kept, kept_durations, frame, duration, static)
+        if not static:
+            reference = current
+    return kept, kept_durations
+
+def decimate(frames, durations, keep_every):
+    """
+    Keeps every keep_every-th frame; each kept frame also gets the durations of the
+    frames dropped after it.
+    """
+    if keep_every <= 1:
+        return list(frames), list(durations)
+    kept = []
+    kept_durations = []
+    for i in range(0, len(frames), keep_every):
+        append_frame(kept, kept_durations, frames[i], sum(durations[i:i + keep_every]))
+    return kept, kept_durations
+
+def fit_to_budget(frames, durations, max_bytes):
+    """
+    Encodes RGB frames with the delta encoder, stepping down BUDGET_LADDER until the
+    result is at most max_bytes. Returns (gif_bytes, settings); if nothing fits,
+    the smallest attempt comes back with settings["fits"] False.
+    """
+    best = None
+    for change_threshold, keep_every, colors in BUDGET_LADDER:
+        step_frames, step_durations = drop_static_frames(frames, durations, change_threshold)
+        step_frames, step_durations = decimate(step_frames, step_durations, keep_every)
+        data = encode_delta_gif(step_frames, step_durations, colors=colors)
+        settings = {
+            "change_threshold": change_threshold,
+            "keep_every": keep_every,
+            "colors": colors,
+            "source_frames": len(frames),
+            "frames": len(step_frames),
+            "bytes": len(data),
+            "max_bytes": max_bytes,
+            "fits": len(data) <= max_bytes,
+        }
+        if best is None or len(data) < len(best[0]):
+            best = (data, settings)
+        if settings["fits"]:
+            return data, settings
+    return best
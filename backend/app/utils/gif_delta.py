@@ -0,0 +1,119 @@
+from PIL import Image, GifImagePlugin
+import numpy as np
+import struct
+from app.utils.image_convert import PALETTE_COLORS, build_global_palette, remap_frames
+
+# Palettes are capped one short of 256 entries so the first unused index can mark
+# pixels that keep the colour of the previous frame.
+MAX_COLORS = 255
+# GIF delays are 16 bit centiseconds; longer holds are spread over repeated frames
+MAX_FRAME_DURATION = 655350
+
+def append_frame(frames, durations, frame, duration, same=False, max_duration=MAX_FRAME_DURATION):
+    """
+    Appends frame with its duration, or with same=True adds the duration to the
+    last frame instead. No delay goes over max_duration (None for no limit); the
+    rest is shown on repeats of the frame.
+    """
+    limit = max_duration or float("inf")
+    while True:
+        if same and (durations[-1] < limit or not duration):
+            part = min(duration, limit - durations[-1])
+            durations[-1] += part
+        else:
+            part = min(duration, limit)
+            frames.append(frame)
+            durations.append(part)
+        duration -= part
+        if duration <= 0:
+            return
+        same = True
+
+def merge_duplicate_frames(frames, durations, max_duration=MAX_FRAME_DURATION):
+    """
+    Collapses runs of identical consecutive frames into one, summing their
+    durations up to max_duration.
+    """
+    merged = []
+    merged_durations = []
+    previous = None
+    for frame, duration in zip(frames, durations):
+        current = np.asarray(frame)
+        same = previous is not None and np.array_equal(current, previous)
+        append_frame(merged, merged_durations, frame, duration, same, max_duration)
+        previous = current
+    return merged, merged_durations
+
+def _frame_bytes(indices, offset, duration, transparency=None):
+    height, width = indices.shape
+    frame = Image.frombytes('P', (width, height), np.ascontiguousarray(indices).tobytes())
+    params = {"duration": duration, "disposal": 1}
+    if transparency is not None:
+        params["transparency"] = transparency
+    # Pillow's C LZW encoder; getdata writes the graphic control extension,
+    # the image descriptor at `offset` and the compressed pixels.
+    return b"".join(GifImagePlugin.getdata(frame, offset=offset, **params))
+
+def _hold_frame(current, duration):
+    # Keeps showing the same image: an opaque 1x1 frame redrawing the top left pixel
+    return _frame_bytes(current[:1, :1], (0, 0), duration)
+
+def _delta_frame(previous, current, duration, transparent_index):
+    changed = previous != current
+    rows = np.flatnonzero(changed.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(changed.any(axis=0))
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    crop = current[top:bottom, left:right]
+    offset = (int(left), int(top))
+    opaque = _frame_bytes(crop, offset, duration)
+    if changed[top:bottom, left:right].all():
+        return opaque
+    # Unchanged pixels inside the box become transparent, which usually gives LZW
+    # longer runs to work with. Keep whichever encoding is smaller.
+    masked = np.where(changed[top:bottom, left:right], crop, transparent_index).astype(np.uint8)
+    transparent = _frame_bytes(masked, offset, duration, transparent_index)
+    return transparent if len(transparent) < len(opaque) else opaque
+
+def encode_delta_gif(frames, durations, loop=0, colors=PALETTE_COLORS):
+    """
+    Encodes RGB frames as the smallest GIF we can produce for the panel.
+
+    Identical frames are merged, every frame is mapped to one global palette, and
+    after the first frame only the bounding box of the pixels that changed is
+    stored (disposal=1, so the panel keeps drawing on top of the previous frame).
+    """
+    # One frame per run here, so a long hold is quantized once; the delays are
+    # split up when the records are built below
+    frames, durations = merge_duplicate_frames(frames, durations, max_duration=None)
+    palette_image = build_global_palette(frames, colors=min(colors, MAX_COLORS))
+    palette = palette_image.getpalette()
+    # Some Pillow versions pad the palette to 256 entries; index 255 is unused either way
+    transparent_index = min(len(palette) // 3, MAX_COLORS)
+    # Smallest power-of-two colour table that still has room for the transparent index
+    table_bits = max(1, transparent_index.bit_length())
+    indices = [np.asarray(f, dtype=np.uint8) for f in remap_frames(frames, palette_image)]
+
+    # Work out the frame list first: a frame that turns out identical after
+    # quantization extends the delay of the frame before it, up to
+    # MAX_FRAME_DURATION; the rest goes on a repeat of the same frame.
+    records = []
+    record_durations = []
+    for i, (current, duration) in enumerate(zip(indices, durations)):
+        append_frame(records, record_durations, current, duration, i > 0 and np.array_equal(indices[i - 1], current))
+
+    width, height = frames[0].size
+    out = [
+        b"GIF89a",
+        struct.pack("<HHBBB", width, height, 0xF0 | (table_bits - 1), 0, 0), # global colour table flag and size
+        bytes(palette).ljust(3 << table_bits, b"\0"),
+        b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\0",
+        _frame_bytes(records[0], (0, 0), record_durations[0]),
+    ]
+    for previous, current, duration in zip(records, records[1:], record_durations[1:]):
+        frame = _delta_frame(previous, current, duration, transparent_index)
+        out.append(frame if frame is not None else _hold_frame(current, duration))
+    out.append(b";")
+    return b"".join(out)
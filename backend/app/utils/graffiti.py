@@ -0,0 +1,83 @@
+from PIL import Image
+import numpy as np
+import io
+from app.utils.image_convert import PANEL_SIZE
+from app.utils import protocol
+
+GRAFFITI_MODE = bytes(protocol.graffiti_mode()) # sent by the app before every drawing session
+PIXEL_PACKET_SIZE = protocol.encoded_size(protocol.GraffitiPixel(0, 0, 0, 0, 0))
+# Length, opcode, sub-opcode and reserved byte; the same for every pixel
+PIXEL_PREFIX = bytes(protocol.graffiti_pixel(0, 0, 0, 0, 0)[:5])
+# Binary messages on /ws/frames: a whole frame, or any number of (x, y, r, g, b) deltas
+FRAME_BYTES = PANEL_SIZE[0] * PANEL_SIZE[1] * 3
+DELTA_SIZE = 5
+
+def to_framebuffer(frame):
+    """
+    Accepts a PIL image, encoded image bytes, a (32, 32, 3) array or 32 rows of
+    "#RRGGBB" strings and returns a (32, 32, 3) uint8 array.
+    """
+    if isinstance(frame, (bytes, bytearray)):
+        with Image.open(io.BytesIO(frame)) as img:
+            frame = img.convert('RGB')
+    if isinstance(frame, Image.Image):
+        if frame.size != PANEL_SIZE:
+            frame = frame.resize(PANEL_SIZE, Image.Resampling.NEAREST)
+        return np.asarray(frame.convert('RGB'), dtype=np.uint8)
+    if isinstance(frame, list):
+        frame = [[list(bytes.fromhex(color.lstrip("#"))) for color in row] for row in frame]
+    pixels = np.asarray(frame, dtype=np.uint8)
+    if pixels.shape != (PANEL_SIZE[1], PANEL_SIZE[0], 3):
+        raise Exception(f"Expected a {PANEL_SIZE[0]}x{PANEL_SIZE[1]} RGB frame, got shape {pixels.shape}")
+    return pixels
+
+def apply_message(canvas, message):
+    """
+    Applies one live-frame message to canvas in place: FRAME_BYTES of row-major RGB
+    replace the whole frame, a multiple of DELTA_SIZE bytes sets single pixels.
+    """
+    if len(message) == FRAME_BYTES:
+        canvas[:] = np.frombuffer(message, dtype=np.uint8).reshape(canvas.shape)
+        return
+    if not message or len(message) % DELTA_SIZE:
+        raise Exception(f"Expected {FRAME_BYTES} bytes or a multiple of {DELTA_SIZE}, got {len(message)}")
+    deltas = np.frombuffer(message, dtype=np.uint8).reshape(-1, DELTA_SIZE)
+    xs, ys = deltas[:, 0], deltas[:, 1]
+    if xs.max() >= PANEL_SIZE[0] or ys.max() >= PANEL_SIZE[1]:
+        raise Exception("Pixel delta outside the panel")
+    canvas[ys, xs] = deltas[:, 2:]
+
+def changed_pixels(current, target):
+    """
+    Returns the pixels of target that differ from current as rows of (x, y, r, g, b).
+    current=None returns every pixel.
+    """
+    if current is None:
+        ys, xs = np.indices(target.shape[:2]).reshape(2, -1)
+    else:
+        ys, xs = np.nonzero((current != target).any(axis=2))
+    return np.column_stack([xs, ys, target[ys, xs]]).astype(np.uint8)
+
+def pixel_packets(pixels):
+    """
+    One graffiti packet per pixel: `0a 00 05 01 00 r g b x y`, see PROTOCOL_NOTES.md.
+    Built as one array instead of protocol.graffiti_pixel per pixel, a full
+    repaint is 1024 packets.
+    """
+    packets = np.empty((len(pixels), PIXEL_PACKET_SIZE), dtype=np.uint8)
+    packets[:, :5] = np.frombuffer(PIXEL_PREFIX, dtype=np.uint8)
+    packets[:, 5:8] = pixels[:, 2:5]
+    packets[:, 8:10] = pixels[:, 0:2]
+    return [row.tobytes() for row in packets]
+
+def encode_frame_gif(target):
+    """
+    Encodes a framebuffer as a single frame GIF. Returns (gif bytes, the pixels
+    the panel will show), which can differ from target after quantization.
+    """
+    out_io = io.BytesIO()
+    Image.fromarray(target, 'RGB').save(out_io, format='GIF')
+    data = out_io.getvalue()
+    with Image.open(io.BytesIO(data)) as img:
+        shown = np.asarray(img.convert('RGB'), dtype=np.uint8)
+    return data, shown
@@ -6,59 +6,135 @@ from PIL import Image, ImageDraw, ImageFont
 import math
 import colorsys
 import io
+import threading
+from app.utils.transport import BleTransport, DEFAULT_WINDOW
+from app.utils.scanner import BleScanner
+from app.utils.simulator import SimulatedAdapter, SIM_PANELS
+from app.utils.image_cache import converted_cache, CachedPayload
+from app.utils.convert_pool import conversion_pipeline, ENGINES
+from app.utils.text_gen import render_text_bitmaps
+from app.utils import graffiti, protocol
+from app.utils.metrics import metrics
+import numpy as np
+import os
 
 SERVICE_UUID = "000000fa-0000-1000-8000-00805f9b34fb"
 WRITE_CMD_UUID = "0000fa02-0000-1000-8000-00805f9b34fb"
-NOTIFICATION_UUID = "0000fa03-0000-1000-8000-00805f9b34fb"
-MIN_BYTE_VALUE = 0x80
+NOTIFICATION_UUID = "0000fa03-0000-1000-8000-00805f9b34fb" # protocol.CHUNK_ACK and TRANSFER_DONE arrive here
+
+CHUNK_SIZE = protocol.CHUNK_SIZE
+CHUNK_DELAY = 0.5 # Fixed wait between chunks when the panel does not acknowledge
+MIN_ACK_TIMEOUT = 0.1
+MAX_ACK_TIMEOUT = 1.0 # PROTOCOL_NOTES: a panel that does not ack is fine after a second
+MAX_ACK_MISSES = 2 # Stop waiting for acks for the rest of a transfer after this many misses
+HEADER_SIZE = protocol.UPLOAD_HEADER_SIZE
+DEFAULT_LINK_BPS = 20000 # Rough BLE payload throughput, used until acks give us a measured RTT
+WALL_SYNC_TIMEOUT = 30.0 # How long a video-wall panel waits for the others before its last chunk
+
+# Everything that changes the converted output; part of the cache key, so bump
+# the version whenever the conversion code changes.
+CONVERT_PARAMS = {"size": 32, "version": 1}
+CONVERT_ENGINE = os.environ.get("IDM_CONVERT_ENGINE", "pillow") # "pillow" or "numpy"
+
+def build_text_payload(bitmaps, num_chars, text_mode=1, speed=95, text_colour_mode=1, text_colour=(255, 0, 0), text_bg_mode=0, text_bg_colour=(0, 0, 0)):
+    """
+    Text metadata followed by the character bitmaps, i.e. everything after the
+    16-byte opcode-0x03 header. The CRC in that header covers exactly this.
+    """
+    return protocol.text_payload(bitmaps, num_chars, text_mode, speed, text_colour_mode, text_colour, text_bg_mode, text_bg_colour)
 
 class IDotMatrix:
-    def __init__(self):
+    def __init__(self, adapter=None, scanner=None):
+        # Panels in a DevicePool share the primary controller's adapter and scanner
         self.peripheral = None
-        self.adapter = self._get_adapter()
+        self.adapter = adapter or self._get_adapter()
+        # Started by the app (see main.py); until then scans are blocking as before
+        self.scanner = scanner or BleScanner(self.adapter)
         self.is_connected = False
 
+        # Flow control for chunked uploads: "ack" sends the next chunk as soon as the
+        # panel acknowledges the previous one, "sleep" keeps the fixed CHUNK_DELAY.
+        self.flow_control = "ack"
+        self._notifications_enabled = False
+        # Acks are counted: chunk n of the connection is acknowledged once n acks
+        # came in, so a late ack for one chunk is never taken for the next one's
+        self._ack_cond = threading.Condition()
+        self._acks_expected = 0
+        self._acks_received = 0
+        self._last_notification = None
+        # Smoothed round-trip time and its variance, used to size the ack timeout
+        self._srtt = None
+        self._rttvar = None
+        self.last_transfer_stats = None
+
+        # Image chunks are streamed as MTU-sized write-without-response slices,
+        # at most stream_window of them in flight (see BleTransport)
+        self.transport = None
+        self.stream_window = DEFAULT_WINDOW
+        self.use_write_command = True
+
+        self.image_cache = converted_cache
+        self.converter = conversion_pipeline
+        self.convert_engine = CONVERT_ENGINE
+        # (crc, length) of the last payload each device fully received, keyed by address
+        self._displayed = {}
+        # Shadow copy of the panel for graffiti mode, a (32, 32, 3) array or None
+        # when we don't know what the panel shows
+        self.framebuffer = None
+        self._graffiti_mode = False
+
     def _get_adapter(self):
+        if SIM_PANELS:
+            # Simulated panels instead of Bluetooth, for testing without hardware
+            return SimulatedAdapter(SIM_PANELS)
         adapters = simplepyble.Adapter.get_adapters()
         if not adapters:
             raise Exception("No Bluetooth adapters found")
         return adapters[0]
 
     def scan_devices(self, timeout=5000):
-        print("Scanning for devices...")
-        self.adapter.scan_for(timeout)
-        peripherals = self.adapter.scan_get_results()
-        devices = []
-        for p in peripherals:
-            if p.identifier().startswith("IDM-") or p.identifier().startswith("LEDnetWF"):
-                devices.append({
-                    "name": p.identifier(),
-                    "address": p.address(),
-                    "rssi": p.rssi()
-                })
+        """
+        Returns the panels seen by the background scanner, strongest signal first.
+        Falls back to a blocking scan while the scanner has nothing yet.
+        """
+        devices = self.scanner.devices()
+        if not devices and self.scanner.cycles == 0:
+            print("Scanning for devices...")
+            self.scanner.scan_once(timeout)
+            devices = self.scanner.devices()
         return devices
 
     def connect(self, address):
-        self.adapter.scan_for(2000) # Quick scan to refresh
-        peripherals = self.adapter.scan_get_results()
-        target = None
-        for p in peripherals:
-            if p.address() == address:
-                target = p
-                break
-        
+        # Reuse the handle the scanner already has, only scan when we never saw the device
+        target = self.scanner.peripheral(address)
+        cached = target is not None
         if not target:
-            raise Exception(f"Device {address} not found during connect scan.")
+            target = self._scan_for(address)
 
         print(f"Connecting to {target.identifier()}...")
-        target.connect()
+        try:
+            with self.scanner.paused():
+                target.connect()
+        except Exception as e:
+            if not cached:
+                raise
+            # The handle can be stale (panel power-cycled, adapter reset), look for the panel again
+            print(f"Connect failed with the cached handle ({e}), scanning again")
+            target = self._scan_for(address)
+            with self.scanner.paused():
+                target.connect()
         self.peripheral = target
         self.is_connected = True
+        self.transport = BleTransport(target, SERVICE_UUID, WRITE_CMD_UUID, window=self.stream_window, use_write_command=self.use_write_command)
+        print(f"MTU: {self.transport.mtu}")
         
+        self._notifications_enabled = False
+        self._srtt = None
+        self._rttvar = None
         try:
-             # Setup notification if needed, usually just connecting is enough for write
-             # self.peripheral.notify(SERVICE_UUID, NOTIFICATION_UUID, self._notification_handler)
-             pass
+            # Chunk acknowledgements arrive here, see _wait_for_chunk_ack
+            self.peripheral.notify(SERVICE_UUID, NOTIFICATION_UUID, self._notification_handler)
+            self._notifications_enabled = True
         except Exception as e:
             print(f"Warning during notify setup: {e}")
 
@@ -67,95 +143,287 @@ class IDotMatrix:
         # self.sync_time() 
         return True
 
+    def _scan_for(self, address):
+        self.scanner.scan_once(2000)
+        target = self.scanner.peripheral(address)
+        if not target:
+            raise Exception(f"Device {address} not found during connect scan.")
+        return target
+
     def disconnect(self):
         if self.peripheral and self.is_connected:
+            self._forget_displayed()
             self.peripheral.disconnect()
             self.is_connected = False
             self.peripheral = None
+            self.transport = None
+            self._notifications_enabled = False
 
     def _write_packet(self, packet):
         if not self.peripheral or not self.is_connected:
              raise Exception("Not connected")
-        self.peripheral.write_request(SERVICE_UUID, WRITE_CMD_UUID, bytes(packet))
+        self.transport.write(packet)
+        metrics.inc("idm_ble_bytes_total", len(packet))
 
     def _notification_handler(self, response):
-        print(f"Response: {response.hex()}")
+        response = bytes(response)
+        self._last_notification = response
+        if response in (protocol.CHUNK_ACK, protocol.TRANSFER_DONE):
+            with self._ack_cond:
+                # Acks nothing is waiting for (after _sync_acks) are dropped
+                if self._acks_received < self._acks_expected:
+                    self._acks_received += 1
+                    self._ack_cond.notify_all()
+        else:
+            print(f"Response: {response.hex()}")
+
+    def _ack_timeout(self):
+        # Like a TCP retransmission timeout: smoothed RTT plus four deviations,
+        # never longer than the second the protocol notes tell us to wait.
+        if self._srtt is None:
+            return MAX_ACK_TIMEOUT
+        return min(max(self._srtt + 4 * self._rttvar, MIN_ACK_TIMEOUT), MAX_ACK_TIMEOUT)
+
+    def _sync_acks(self):
+        # Forgets acks still owed from earlier writes, before a new transfer starts
+        with self._ack_cond:
+            self._acks_received = self._acks_expected
+
+    def _expect_ack(self):
+        # Called before writing a chunk; returns the ack count that acknowledges it
+        with self._ack_cond:
+            self._acks_expected += 1
+            return self._acks_expected
+
+    def _update_rtt(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+    def _wait_for_chunk_ack(self, started, use_ack, seq):
+        """
+        Blocks until the panel is ready for the next chunk, i.e. until ack number
+        seq (from _expect_ack) arrived.
+        Returns the round-trip time in seconds, or None if no ack arrived.
+        """
+        waited = time.perf_counter()
+        if not use_ack:
+            time.sleep(CHUNK_DELAY)
+            metrics.observe("ble.fixed_delay", time.perf_counter() - waited)
+            return None
+        with self._ack_cond:
+            acked = self._ack_cond.wait_for(lambda: self._acks_received >= seq, self._ack_timeout())
+        metrics.observe("ble.ack_wait", time.perf_counter() - waited)
+        if acked:
+            rtt = time.perf_counter() - started
+            self._update_rtt(rtt)
+            return rtt
+        # No ack within the timeout; the wait itself was the adaptive delay
+        metrics.inc("idm_ack_timeouts_total")
+        return None
+
+    def _forget_displayed(self):
+        # The panel no longer shows what we last sent, the next send must go out in full
+        if self.peripheral:
+            self._displayed.pop(self.peripheral.address(), None)
+        self.framebuffer = None
+        self._graffiti_mode = False
 
     def switch_on(self, state):
-        packet = bytearray.fromhex("05 00 07 01 01")
-        packet[4] = 1 if state else 0
-        self._write_packet(packet)
+        self._forget_displayed()
+        self._write_packet(protocol.power(state))
 
     def sync_time(self):
-        current_time = time.localtime(time.time())
-        year = current_time.tm_year & 0xff
-        month = current_time.tm_mon
-        day = current_time.tm_mday
-        dow = current_time.tm_wday + 1
-        hour = current_time.tm_hour
-        minute = current_time.tm_min
-        seconds = current_time.tm_sec
-        packet = bytearray.fromhex("0b 00 01 80 e7 0c 12 01 0a 26 10")
-        packet[3] = MIN_BYTE_VALUE
-        packet[4] = year
-        packet[5] = month
-        packet[6] = day
-        packet[7] = dow
-        packet[8] = hour
-        packet[9] = minute
-        packet[10] = seconds
-        self._write_packet(packet)
+        self._write_packet(protocol.time_sync())
 
-    def send_image(self, image_data: bytes):
+    def send_image(self, image_data: bytes, crc=None, force=False, barrier=None):
         """
         Expects a 32x32 GIF or Image bytes. 
         If it's a static image, we might need to convert it to a single frame GIF or handled differently.
         The original code treats GIFs specially with chunking.
+        Returns transfer stats, including the per-chunk ack round-trip times.
+        Sending the payload the panel is already showing is a no-op unless force is set.
+        barrier (a threading.Barrier shared by the panels of a video wall) is
+        waited on before the last chunk, so all the animations start together.
         """
-        # Calculate CRC
-        crc = zlib.crc32(image_data)
-        
-        # Build Header
-        header = bytearray.fromhex("FF FF 01 00 00 FF FF FF FF FF FF FF FF 05 00 0d")
-        header[9]  = crc.to_bytes(4, byteorder='little')[0]
-        header[10] = crc.to_bytes(4, byteorder='little')[1]
-        header[11] = crc.to_bytes(4, byteorder='little')[2]
-        header[12] = crc.to_bytes(4, byteorder='little')[3]
-
-        l = len(image_data)
-        total_len = l + (len(header) * 2) 
-        # Note: Original code logic for total_len might be specific to their protocol interpretation
-        
-        header[5] = total_len.to_bytes(4, byteorder='little')[0]
-        header[6] = total_len.to_bytes(4, byteorder='little')[1]
-        header[7] = total_len.to_bytes(4, byteorder='little')[2]
-        header[8] = total_len.to_bytes(4, byteorder='little')[3]
-
-        chunks = []
-        for i in range(0, len(image_data), 4096):
-            chunk = image_data[i:i+4096]
-            chunks.append(chunk)
-
-        for i in range(len(chunks)):
-            if i > 0: header[4] = 2
-            else: header[4] = 0
-            
-            chunk_len = len(chunks[i]) + len(header)
-            header[0] = chunk_len.to_bytes(2, byteorder='little')[0]
-            header[1] = chunk_len.to_bytes(2, byteorder='little')[1]
-
-            self._write_packet(header + chunks[i])
-            time.sleep(0.5) # Wait between chunks
-        
-        # Original code had a reset or something at the end?
-        # send_reset_command() was called in main
-        # self.send_reset_command()
+        return self._send_chunked(protocol.GIF_UPLOAD, image_data, crc, force, barrier)
 
-    def send_reset_command(self):
-        packet = bytearray.fromhex("04 00 03 80")
-        self._write_packet(packet)
-        packet = bytearray.fromhex("05 00 04 80 50")
+    def send_text(self, text, text_mode=1, speed=95, text_colour_mode=1, text_colour=(255, 0, 0), text_bg_mode=0, text_bg_colour=(0, 0, 0), force=False):
+        """
+        Sends text with the panel's native text command (opcode 0x03): one 16x32
+        1-bit bitmap per character, and the panel does the scrolling itself.
+        text_mode: 0 fixed, 1 scroll left, 2 scroll right, 3 up, 4 down, 5 strobe,
+        6 fade, 7 falling blocks, 8 laser (see docs/PROTOCOL_NOTES.md).
+        """
+        with metrics.span("text.render"):
+            payload = build_text_payload(render_text_bitmaps(text), len(text), text_mode, speed, text_colour_mode, text_colour, text_bg_mode, text_bg_colour)
+        return self._send_chunked(protocol.TEXT_UPLOAD, payload, None, force)
+
+    def _send_chunked(self, opcode, payload, crc=None, force=False, barrier=None):
+        """
+        Sends a payload as opcode (protocol.GIF_UPLOAD or TEXT_UPLOAD) upload
+        chunks of CHUNK_SIZE bytes, framed by protocol.Upload in one buffer.
+        """
+        if not self.peripheral or not self.is_connected:
+            raise Exception("Not connected")
+
+        # Calculate CRC, unless it came with a cached payload
+        if crc is None:
+            with metrics.span("crc"):
+                crc = zlib.crc32(payload)
+
+        address = self.peripheral.address()
+        # A synced start needs every panel of the wall to restart its animation
+        if not force and barrier is None and self._displayed.get(address) == (crc, len(payload)):
+            metrics.inc("idm_transfers_total", result="skipped")
+            return {"bytes": len(payload), "chunks": 0, "skipped": True}
+        # Until the last chunk is through, the panel is showing neither the old nor the new payload
+        self._displayed.pop(address, None)
+        self.framebuffer = None
+        self._graffiti_mode = False
+
+        l = len(payload)
+        chunks = protocol.Upload(opcode, payload, crc, CHUNK_SIZE).packets
+
+        use_ack = self.flow_control == "ack" and self._notifications_enabled
+        self._sync_acks()
+        misses = 0
+        rtts = []
+        slices_before = self.transport.slices_written if self.transport else 0
+        barrier_wait = None
+        transfer_start = time.perf_counter()
+        # The background scanner would take radio time from the upload
+        with self.scanner.paused():
+            for i in range(len(chunks)):
+                if barrier is not None and i == len(chunks) - 1:
+                    # The panel starts playing once the last chunk is in
+                    waited = time.perf_counter()
+                    try:
+                        barrier.wait(WALL_SYNC_TIMEOUT)
+                    except threading.BrokenBarrierError:
+                        # Another panel failed or was superseded, show this tile anyway
+                        print("Video wall panels out of sync, sending the last chunk unsynced")
+                    barrier_wait = time.perf_counter() - waited
+
+                # Counted before writing, the ack can arrive while write_request is still returning
+                seq = self._expect_ack()
+                started = time.perf_counter()
+                self._write_packet(chunks[i])
+                metrics.observe("ble.write", time.perf_counter() - started)
+                rtt = self._wait_for_chunk_ack(started, use_ack, seq)
+                rtts.append(rtt)
+                if use_ack and rtt is None:
+                    misses += 1
+                    if misses >= MAX_ACK_MISSES:
+                        print("Panel is not acknowledging chunks, falling back to fixed delay")
+                        use_ack = False
+                else:
+                    misses = 0
+
+        elapsed = time.perf_counter() - transfer_start
+        metrics.observe("ble.transfer", elapsed)
+        metrics.inc("idm_transfers_total", result="sent")
+        metrics.inc("idm_ble_chunks_total", len(chunks))
+        self._displayed[address] = (crc, l)
+        self.last_transfer_stats = {
+            "bytes": l,
+            "skipped": False,
+            "chunks": len(chunks),
+            "mtu": self.transport.mtu,
+            "window": self.transport.window,
+            "slices": self.transport.slices_written - slices_before,
+            "acked_chunks": sum(1 for r in rtts if r is not None),
+            "chunk_rtts_ms": [round(r * 1000, 1) if r is not None else None for r in rtts],
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "throughput_bps": round(l / elapsed) if elapsed > 0 else None,
+        }
+        if barrier is not None:
+            self.last_transfer_stats["barrier_wait_ms"] = round(barrier_wait * 1000, 1)
+        return self.last_transfer_stats
+
+    def paint_frame(self, frame, force=False):
+        """
+        Brings the panel to show frame using graffiti pixel writes.
+
+        The frame is compared with the shadow framebuffer and only the pixels that
+        changed are sent, pipelined as write-without-response. When those packets
+        would add up to more bytes than the frame as a GIF, the GIF is uploaded
+        instead. Entering graffiti mode starts from a black canvas, so when the
+        panel shows a GIF we painted and the frame is a small change to it, the
+        switch is made anyway: the fill is paid once, where staying in GIF mode
+        would cost a whole GIF for every frame that follows.
+        force repaints every pixel.
+        """
+        if not self.peripheral or not self.is_connected:
+            raise Exception("Not connected")
+        target = graffiti.to_framebuffer(frame)
+        started = time.perf_counter()
+
+        if not force and self.framebuffer is not None and np.array_equal(self.framebuffer, target):
+            return {"mode": "graffiti" if self._graffiti_mode else "gif", "pixels": 0, "bytes": 0, "skipped": True}
+        gif_data, shown = graffiti.encode_frame_gif(target)
+        gif_bytes = len(gif_data) + HEADER_SIZE
+        # We assume the panel clears to black when it enters graffiti mode (the
+        # simulator does the same); nothing else it was showing survives the switch
+        current = self.framebuffer if self._graffiti_mode else np.zeros_like(target)
+        if force:
+            current = None
+        pixels = graffiti.changed_pixels(current, target)
+        pixel_bytes = len(pixels) * graffiti.PIXEL_PACKET_SIZE + (0 if self._graffiti_mode else len(graffiti.GRAFFITI_MODE))
+
+        switch = False
+        if pixel_bytes > gif_bytes and not force and not self._graffiti_mode and self.framebuffer is not None:
+            # The panel shows a GIF we painted: what the following frames cost is the change from it
+            switch = len(graffiti.changed_pixels(self.framebuffer, target)) * graffiti.PIXEL_PACKET_SIZE <= gif_bytes
+        if pixel_bytes > gif_bytes and not switch:
+            stats = self.send_image(gif_data, force=force)
+            # send_image forgets the framebuffer; we know exactly what the GIF shows
+            self.framebuffer = shown
+            return dict(stats, mode="gif", pixels=len(pixels), graffiti_bytes=pixel_bytes)
+
+        with self.scanner.paused():
+            if not self._graffiti_mode:
+                self._write_packet(graffiti.GRAFFITI_MODE)
+                self._graffiti_mode = True
+            self._displayed.pop(self.peripheral.address(), None)
+            if len(pixels):
+                self.transport.write_many(graffiti.pixel_packets(pixels))
+                metrics.inc("idm_ble_bytes_total", len(pixels) * graffiti.PIXEL_PACKET_SIZE)
+        self.framebuffer = target
+        elapsed = time.perf_counter() - started
+        self.last_transfer_stats = {
+            "mode": "graffiti",
+            "pixels": len(pixels),
+            "bytes": pixel_bytes,
+            "gif_bytes": len(gif_data),
+            "skipped": False,
+            "elapsed_ms": round(elapsed * 1000, 1),
+        }
+        return self.last_transfer_stats
+
+    def send_packet(self, packet, wait_for_ack=False):
+        """
+        Writes one already encoded packet, e.g. from a capture being replayed.
+        With wait_for_ack it then waits for the panel like after an upload chunk
+        and returns the round-trip time (None without an ack).
+        """
+        self._forget_displayed()
+        if not wait_for_ack:
+            self._write_packet(packet)
+            return None
+        self._sync_acks()
+        seq = self._expect_ack()
+        started = time.perf_counter()
         self._write_packet(packet)
+        return self._wait_for_chunk_ack(started, self._notifications_enabled, seq)
+
+    def send_reset_command(self):
+        self._forget_displayed()
+        for packet in protocol.RESET:
+            self._write_packet(packet)
 
     def set_mode_clock(self):
         # Based on common behavior, resetting usually brings back the default clock/animation loop
@@ -163,62 +431,107 @@ class IDotMatrix:
         # Let's try sending the reset command which seems to be "Mode Switch" or "Reset to Default"
         self.send_reset_command()
 
-    def convert_image_to_32x32(self, image_path_or_file):
-        from PIL import ImageSequence, ImageOps
-        with Image.open(image_path_or_file) as img:
-            out_io = io.BytesIO()
-            
-            if getattr(img, "is_animated", False):
-                frames = []
-                durations = []
-                # Loop through frames
-                for frame in ImageSequence.Iterator(img):
-                    # Restore duration to default if likely invalid (0)
-                    d = frame.info.get('duration', 100)
-                    if d < 20: d = 100 # Sanity check for extremely fast/broken durations
-                    durations.append(d)
-                    
-                    # Convert to RGBA to handle transparency correctly during resize
-                    current_frame = frame.convert('RGBA')
-                    
-                    # High quality resize
-                    current_frame = current_frame.resize((32, 32), Image.Resampling.LANCZOS)
-                    
-                    # Create a black background to merge transparency (device might not support transparency well)
-                    # or just keep it. Let's try to keep it but convert to P mode properly.
-                    # Best practice for pixel art LED displays: Avoid partial transparency.
-                    # Start with a black canvas
-                    new_frame = Image.new('RGB', (32, 32), (0, 0, 0))
-                    new_frame.paste(current_frame, (0, 0), mask=current_frame.split()[3]) # Use alpha channel as mask
-                    
-                    # Convert to P mode for GIF compatibility (256 colors max)
-                    # Using ADAPTIVE palette for better colors
-                    frames.append(new_frame.convert('P', palette=Image.Palette.ADAPTIVE, colors=255))
-
-                # Save as GIF
-                # duration takes a list of integers for each frame
-                # disposal=2 forces background clear before next frame (helps with ghosting)
-                frames[0].save(
-                    out_io, 
-                    format='GIF', 
-                    save_all=True, 
-                    append_images=frames[1:], 
-                    loop=0, 
-                    duration=durations, 
-                    disposal=2,
-                    optimize=False
-                )
+    def _read_source(self, image_path_or_file, engine=None):
+        """
+        Returns (source bytes, engine) for a path or file object, with engine
+        defaulting to convert_engine and checked against ENGINES.
+        """
+        if hasattr(image_path_or_file, "read"):
+            source = image_path_or_file.read()
+        else:
+            with open(image_path_or_file, "rb") as f:
+                source = f.read()
+        engine = engine or self.convert_engine
+        if engine not in ENGINES:
+            raise Exception(f"Unknown conversion engine: {engine}")
+        return source, engine
+
+    def convert_payload(self, image_path_or_file, engine=None, palette="adaptive", delta=False):
+        """
+        Converts an image to a 32x32 GIF payload through the converted image cache.
+        Returns a CachedPayload of (gif bytes, crc32).
+        A palette="global" conversion also caches the per-frame "adaptive" variant,
+        so comparing the two sizes afterwards costs nothing.
+        delta=True produces the smallest payload: duplicate frames merged and
+        later frames cropped to what changed.
+        """
+        source, engine = self._read_source(image_path_or_file, engine)
+        if palette not in ("adaptive", "global"):
+            raise Exception(f"Unknown palette mode: {palette}")
+        key = self.image_cache.make_key(source, dict(CONVERT_PARAMS, engine=engine, palette=palette, delta=bool(delta)))
+        cached = self.image_cache.get(key)
+        if cached is not None:
+            metrics.inc("idm_convert_cache_total", result="hit")
+            return cached
+        metrics.inc("idm_convert_cache_total", result="miss")
+        with metrics.span("convert"):
+            if delta:
+                return self.image_cache.put(key, self.converter.convert(source, engine=engine, delta=True))
+            if palette == "global":
+                variants = self.converter.convert_palette_variants(source, engine=engine)
+                adaptive_key = self.image_cache.make_key(source, dict(CONVERT_PARAMS, engine=engine, palette="adaptive", delta=False))
+                self.image_cache.put(adaptive_key, variants["adaptive"])
+                return self.image_cache.put(key, variants["global"])
+            return self.image_cache.put(key, self.converter.convert(source, engine=engine))
+
+    def convert_wall(self, image_path_or_file, cols, rows, engine=None):
+        """
+        Converts an image for a cols x rows video wall: one CachedPayload per
+        panel, row by row. Tiles are cached individually.
+        """
+        source, engine = self._read_source(image_path_or_file, engine)
+        keys = [
+            self.image_cache.make_key(source, dict(CONVERT_PARAMS, engine=engine, wall=[cols, rows], tile=i))
+            for i in range(cols * rows)
+        ]
+        cached = [self.image_cache.get(key) for key in keys]
+        if all(c is not None for c in cached):
+            return cached
+        tiles = self.converter.convert_wall(source, cols, rows, engine=engine)
+        return [self.image_cache.put(key, tile) for key, tile in zip(keys, tiles)]
+
+    def convert_to_budget(self, image_path_or_file, max_bytes=None, max_seconds=None, engine=None):
+        """
+        Converts an image so its payload fits in max_bytes, or uploads within
+        max_seconds, decimating frames and shrinking the palette as needed.
+        Returns (CachedPayload, report) where the report holds the chosen settings
+        and the estimated transfer time. Budgeted conversions are not cached.
+        """
+        if max_bytes is None and max_seconds is None:
+            raise Exception("Either max_bytes or max_seconds is required")
+        source, engine = self._read_source(image_path_or_file, engine)
+        if max_seconds is not None:
+            by_time = self.bytes_for_transfer_time(max_seconds)
+            max_bytes = by_time if max_bytes is None else min(max_bytes, by_time)
+        data, settings = self.converter.convert_to_budget(source, max_bytes, engine=engine)
+        settings["estimated_transfer_s"] = self.estimate_transfer_time(len(data))
+        return CachedPayload(data, zlib.crc32(data)), settings
+
+    def estimate_transfer_time(self, n_bytes):
+        """
+        Seconds an upload of n_bytes should take with the current flow control.
+        Uses the measured ack round-trip time per chunk once we have one, otherwise
+        the wire time plus the fixed per-chunk delay.
+        """
+        chunks = max(1, math.ceil(n_bytes / CHUNK_SIZE))
+        if self.flow_control == "ack" and self._notifications_enabled and self._srtt is not None:
+            return round(chunks * self._srtt, 3)
+        wire = (n_bytes + chunks * HEADER_SIZE) / DEFAULT_LINK_BPS
+        return round(wire + chunks * CHUNK_DELAY, 3)
+
+    def bytes_for_transfer_time(self, seconds):
+        # Largest payload whose estimated upload time fits, by binary search
+        lo, hi = 0, 64 * 1024 * 1024
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.estimate_transfer_time(mid) <= seconds:
+                lo = mid
             else:
-                # Static image
-                img = img.convert('RGBA')
-                img = img.resize((32, 32), Image.Resampling.LANCZOS)
-                new_img = Image.new('RGB', (32, 32), (0, 0, 0))
-                new_img.paste(img, (0, 0), mask=img.split()[3])
-                
-                new_img.save(out_io, format='GIF')
-            
-            
-            return out_io.getvalue()
+                hi = mid - 1
+        return lo
+
+    def convert_image_to_32x32(self, image_path_or_file):
+        return self.convert_payload(image_path_or_file).data
 
     def get_connection_status(self):
         if self.peripheral and self.is_connected:
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from app.utils.metrics import metrics
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), ".cache", "converted")
+MEMORY_LIMIT = 16 * 1024 * 1024
+DISK_LIMIT = 256 * 1024 * 1024
+
+# Final GIF bytes ready for send_image, plus their zlib.crc32 for the upload header
+CachedPayload = namedtuple("CachedPayload", ["data", "crc"])
+
+class ConvertedImageCache:
+    """
+    Two-level LRU cache of converted 32x32 GIF payloads.
+
+    Entries are keyed by the SHA-256 of the source image bytes plus the conversion
+    parameters, so the same picture uploaded twice (or the same URL fetched again)
+    skips Pillow entirely. Both levels are bounded by total payload bytes; the disk
+    level survives restarts. Pass directory=None for a memory-only cache.
+    """
+
+    def __init__(self, directory=CACHE_DIR, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict() # key -> file size, least recently used first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._directory_ready = False # created on the first write, not on import
+        self.hits = 0
+        self.misses = 0
+        if self.directory:
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(source_bytes, params):
+        h = hashlib.sha256(source_bytes)
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".gif")
+
+    def _load_disk_index(self):
+        if not os.path.exists(self.directory):
+            return
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".gif"):
+                    continue
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        except OSError as e:
+            print(f"Disabling disk cache: {e}")
+            self.directory = None
+            return
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                data = None
+            with self._lock:
+                if data is None:
+                    self._drop_disk(key)
+                else:
+                    self._disk.move_to_end(key)
+                    entry = CachedPayload(data, zlib.crc32(data))
+                    self._put_memory(key, entry)
+                    self.hits += 1
+                    return entry
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        with metrics.span("crc"):
+            entry = CachedPayload(bytes(data), zlib.crc32(data))
+        with self._lock:
+            self._put_memory(key, entry)
+        if self.directory and len(data) <= self.disk_limit:
+            path = self._path(key)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                if not self._directory_ready:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._directory_ready = True
+                with open(tmp, "wb") as f:
+                    f.write(entry.data)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"Could not write cache entry: {e}")
+                return entry
+            with self._lock:
+                self._drop_disk(key)
+                self._disk[key] = len(data)
+                self._disk_bytes += len(data)
+                while self._disk_bytes > self.disk_limit:
+                    oldest = next(iter(self._disk))
+                    self._drop_disk(oldest)
+                    try:
+                        os.remove(self._path(oldest))
+                    except OSError:
+                        pass
+        return entry
+
+    def _put_memory(self, key, entry):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old.data)
+        if len(entry.data) > self.memory_limit:
+            return
+        self._memory[key] = entry
+        self._memory_bytes += len(entry.data)
+        while self._memory_bytes > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.data)
+
+    def _drop_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+converted_cache = ConvertedImageCache()
@@ -0,0 +1,119 @@
+from PIL import Image
+import io
+
+PANEL_SIZE = (32, 32)
+PALETTE_COLORS = 255
+KMEANS_PASSES = 2 # k-means refinement passes on top of the median-cut global palette
+
+# Module-level functions only: everything here runs inside ProcessPoolExecutor
+# workers (see convert_pool.py) and has to be importable without touching BLE.
+
+def frame_duration(frame):
+    # Restore duration to default if likely invalid (0)
+    d = frame.info.get('duration', 100)
+    if d < 20: d = 100 # Sanity check for extremely fast/broken durations
+    return d
+
+def prepare_frame(frame, size=PANEL_SIZE):
+    # Convert to RGBA to handle transparency correctly during resize
+    current_frame = frame.convert('RGBA')
+
+    # High quality resize
+    current_frame = current_frame.resize(size, Image.Resampling.LANCZOS)
+
+    # Create a black background to merge transparency (device might not support transparency well)
+    # Best practice for pixel art LED displays: Avoid partial transparency.
+    new_frame = Image.new('RGB', size, (0, 0, 0))
+    new_frame.paste(current_frame, (0, 0), mask=current_frame.split()[3]) # Use alpha channel as mask
+    return new_frame
+
+def quantize_frame(frame):
+    # Convert to P mode for GIF compatibility (256 colors max)
+    # Using ADAPTIVE palette for better colors
+    return frame.convert('P', palette=Image.Palette.ADAPTIVE, colors=PALETTE_COLORS)
+
+def build_global_palette(frames, colors=PALETTE_COLORS):
+    """
+    Builds one palette for a whole animation: median cut over the pixels of every
+    frame stacked into a single strip, refined with a few k-means passes.
+    Returns a P-mode image to pass to remap_frames.
+    """
+    width, height = frames[0].size
+    strip = Image.new('RGB', (width, height * len(frames)))
+    for i, frame in enumerate(frames):
+        strip.paste(frame, (0, height * i))
+    return strip.quantize(colors=colors, method=Image.Quantize.MEDIANCUT, kmeans=KMEANS_PASSES)
+
+def remap_frames(frames, palette_image):
+    return [f.quantize(palette=palette_image, dither=Image.Dither.NONE) for f in frames]
+
+def render_frames(source_bytes, start=0, stop=None, quantize=True, size=PANEL_SIZE):
+    """
+    Converts frames [start, stop) of the source image.
+    Returns (frames, durations, animated); animated frames are quantized unless
+    quantize is False, a static image comes back as a single RGB frame.
+    """
+    with Image.open(io.BytesIO(source_bytes)) as img:
+        if not getattr(img, "is_animated", False):
+            return [prepare_frame(img, size)], [], False
+        frames = []
+        durations = []
+        stop = img.n_frames if stop is None else min(stop, img.n_frames)
+        for index in range(start, stop):
+            # Seeking forward decodes the frames in between, GIF frames build on each other
+            img.seek(index)
+            durations.append(frame_duration(img))
+            frame = prepare_frame(img, size)
+            frames.append(quantize_frame(frame) if quantize else frame)
+        return frames, durations, True
+
+def encode_gif(frames, durations, animated, palette_image=None):
+    """
+    With palette_image (frames already remapped to it) the palette is written once as
+    the global colour table and every frame drops its local table.
+    """
+    out_io = io.BytesIO()
+    if animated:
+        # duration takes a list of integers for each frame
+        # disposal=2 forces background clear before next frame (helps with ghosting)
+        frames[0].save(
+            out_io,
+            format='GIF',
+            save_all=True,
+            append_images=frames[1:],
+            loop=0,
+            duration=durations,
+            disposal=2,
+            optimize=False,
+            **({"palette": palette_image.getpalette()} if palette_image else {})
+        )
+    else:
+        frames[0].save(out_io, format='GIF')
+    return out_io.getvalue()
+
+def slice_tiles(frames, cols, rows):
+    """
+    Cuts frames rendered at (32*cols)x(32*rows) into one 32x32 frame list per
+    panel, row by row.
+    """
+    width, height = PANEL_SIZE
+    return [
+        [f.crop((col * width, row * height, (col + 1) * width, (row + 1) * height)) for f in frames]
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+def encode_tile(frames, durations, animated):
+    # Tiles are cut from unquantized frames, each one gets its own palettes
+    if animated:
+        frames = [quantize_frame(f) for f in frames]
+    return encode_gif(frames, durations, animated)
+
+def frame_count(source_bytes):
+    with Image.open(io.BytesIO(source_bytes)) as img:
+        if not getattr(img, "is_animated", False):
+            return 1
+        return img.n_frames
+
+def render_32x32_gif(source_bytes):
+    return encode_gif(*render_frames(source_bytes))
@@ -0,0 +1,141 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds; BLE stages run from milliseconds to tens of seconds
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TRACE_HEADER = "X-IDM-Trace"
+
+# Stage timings of the request being traced, a list of (stage, seconds), or None
+_trace = contextvars.ContextVar("idm_trace", default=None)
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Histogram:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """
+    In-process counters and stage-latency histograms, rendered in the Prometheus
+    text exposition format by render().
+
+    Stages are timed with span() (or observe() for durations measured some other
+    way) into the idm_stage_seconds histogram. While a request is being traced
+    (see start_trace) the same timings are also collected for that request, so
+    they can be sent back to the caller. Work that runs on the BLE worker sees
+    the trace too, because jobs run in the context they were submitted from.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {} # (name, labels) -> Histogram
+        self._counters = {} # (name, labels) -> value
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage, seconds):
+        self.record("idm_stage_seconds", seconds, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((stage, seconds))
+
+    def record(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            histograms = [(key, list(h.buckets), list(h.counts), h.total, h.count) for key, h in histograms]
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), buckets, counts, total, count in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(labels)} {round(total, 6)}")
+            lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def start_trace():
+    """
+    Starts collecting stage timings for the current request; returns the list
+    they are appended to.
+    """
+    trace = []
+    _trace.set(trace)
+    return trace
+
+def summarize_trace(trace):
+    """
+    Sums a trace per stage, in the order the stages first ran:
+    [(stage, total seconds, times run)].
+    """
+    totals = {}
+    for stage, seconds in list(trace):
+        total, count = totals.get(stage, (0.0, 0))
+        totals[stage] = (total + seconds, count + 1)
+    return [(stage, total, count) for stage, (total, count) in totals.items()]
+
+def server_timing(trace):
+    # Server-Timing header value; browsers show it in the network panel
+    return ", ".join(f"{stage};dur={total * 1000:.1f}" for stage, total, _ in summarize_trace(trace))
+
+metrics = Metrics()
+metrics.describe("idm_stage_seconds", "Time spent in each stage of the upload pipelines")
+metrics.describe("idm_http_requests_total", "HTTP requests by route and status code")
+metrics.describe("idm_http_request_seconds", "HTTP request latency by route")
+metrics.describe("idm_convert_cache_total", "Converted image cache lookups by result")
+metrics.describe("idm_transfers_total", "Chunked uploads to a panel by result")
+metrics.describe("idm_ble_bytes_total", "Bytes written to panels")
+metrics.describe("idm_ble_chunks_total", "4 KB upload chunks written to panels")
+metrics.describe("idm_ack_timeouts_total", "Upload chunks the panel did not acknowledge in time")
+metrics.describe("idm_download_bytes_total", "Image bytes downloaded from URLs")
@@ -0,0 +1,102 @@
+from PIL import Image
+import numpy as np
+import io
+from app.utils.image_convert import PANEL_SIZE, frame_duration, quantize_frame
+
+# Integer downscale ratios at or above this use plain area averaging (a reshape and
+# a mean) instead of the Lanczos weight matrices.
+AREA_MIN_RATIO = 4
+# Frames are decoded in batches of at most this many source pixels to bound memory
+BATCH_PIXELS = 16 * 1024 * 1024
+
+def _lanczos(x, a=3):
+    x = np.abs(x)
+    out = np.sinc(x) * np.sinc(x / a)
+    out[x >= a] = 0
+    return out
+
+def lanczos_weights(in_size, out_size, a=3):
+    """
+    Returns an (out_size, in_size) matrix that resamples one axis the way
+    Pillow's LANCZOS filter does: the kernel is stretched by the scale factor when
+    downscaling and every output row is normalised to sum to one.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = a * filterscale
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        xs = np.arange(xmin, xmax)
+        w = _lanczos((xs - center + 0.5) / filterscale, a)
+        total = w.sum()
+        weights[i, xmin:xmax] = w / total if total else 0
+    return weights
+
+def decode_frames(img, start, stop):
+    """
+    Decodes frames [start, stop) of an open image into one (n, H, W, 4) RGBA array.
+    """
+    width, height = img.size
+    rgba = np.empty((stop - start, height, width, 4), dtype=np.uint8)
+    durations = []
+    for i, index in enumerate(range(start, stop)):
+        img.seek(index)
+        durations.append(frame_duration(img))
+        rgba[i] = np.asarray(img.convert('RGBA'))
+    return rgba, durations
+
+def composite_on_black(rgba):
+    # Same result as pasting the frame onto a black canvas with its alpha as mask
+    alpha = rgba[..., 3:4].astype(np.float32) * (1.0 / 255)
+    return rgba[..., :3] * alpha
+
+def resize_batch(rgb, size=PANEL_SIZE):
+    """
+    Downscales a (n, H, W, 3) float batch to (n, size[1], size[0], 3) in one go.
+    """
+    n, height, width, _ = rgb.shape
+    out_w, out_h = size
+    if (width, height) == (out_w, out_h):
+        return rgb
+    fx, fy = width / out_w, height / out_h
+    if fx.is_integer() and fy.is_integer() and min(fx, fy) >= AREA_MIN_RATIO:
+        fx, fy = int(fx), int(fy)
+        return rgb.reshape(n, out_h, fy, out_w, fx, 3).mean(axis=(2, 4))
+    wy = lanczos_weights(height, out_h)
+    wx = lanczos_weights(width, out_w)
+    # Rows first, then columns, each as a single matrix product over the whole batch
+    rows = np.einsum('yh,nhwc->nywc', wy, rgb, optimize=True)
+    return np.einsum('xw,nywc->nyxc', wx, rows, optimize=True)
+
+def to_images(batch):
+    pixels = np.clip(np.rint(batch), 0, 255).astype(np.uint8)
+    return [Image.fromarray(frame, 'RGB') for frame in pixels]
+
+def render_frames(source_bytes, start=0, stop=None, quantize=True, size=PANEL_SIZE):
+    """
+    Drop-in replacement for image_convert.render_frames. Frames go through the same
+    quantizer and GIF encoder, so the output is an ordinary P-mode GIF. Pixel values
+    differ slightly from the Pillow path: large integer ratios are area averaged, and
+    Lanczos runs in float where Pillow uses 8-bit fixed point.
+    """
+    with Image.open(io.BytesIO(source_bytes)) as img:
+        animated = getattr(img, "is_animated", False)
+        n_frames = img.n_frames if animated else 1
+        stop = n_frames if stop is None else min(stop, n_frames)
+        width, height = img.size
+        batch = max(1, BATCH_PIXELS // (width * height))
+        frames = []
+        durations = []
+        for batch_start in range(start, stop, batch):
+            batch_stop = min(batch_start + batch, stop)
+            rgba, batch_durations = decode_frames(img, batch_start, batch_stop)
+            small = to_images(resize_batch(composite_on_black(rgba), size))
+            if animated and quantize:
+                small = [quantize_frame(f) for f in small]
+            frames.extend(small)
+            if animated:
+                durations.extend(batch_durations)
+        return frames, durations, animated
@@ -0,0 +1,251 @@
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+# Packet layouts of the iDotMatrix protocol, see docs/PROTOCOL_NOTES.md.
+#
+# Every packet starts with its own length (2 bytes, little endian, counting the
+# whole packet), an opcode and a sub-opcode. Encoders write with
+# struct.pack_into into preallocated buffers; decoders read with
+# struct.unpack_from and hand out memoryviews instead of copies. Nothing here
+# talks to Bluetooth, so the legacy script and the tools can import it too.
+
+MIN_BYTE_VALUE = 0x80
+CHUNK_SIZE = 4096
+UPLOAD_HEADER_SIZE = 16
+TEXT_METADATA_SIZE = 14
+
+GIF_UPLOAD = 0x01
+TEXT_UPLOAD = 0x03
+# The last three header bytes differ per upload type
+UPLOAD_TRAILERS = {GIF_UPLOAD: bytes.fromhex("05 00 0d"), TEXT_UPLOAD: bytes.fromhex("00 00 0c")}
+FIRST_CHUNK = 0
+MORE_CHUNKS = 2
+# Notifications the panel sends during an upload
+CHUNK_ACK = bytes.fromhex("05 00 01 00 01") # chunk received, ready for the next one
+TRANSFER_DONE = bytes.fromhex("05 00 01 00 03") # whole payload received
+
+PREFIX = struct.Struct("<HBB")
+# length, opcode, 0, continuation flag, total length, CRC32 of the whole payload, trailer
+UPLOAD_HEADER = struct.Struct("<HBBBII3s")
+# characters, 0, 1, mode, speed, colour mode, r, g, b, background mode, r, g, b
+TEXT_METADATA = struct.Struct("<HBBBBBBBBBBBB")
+# Every character bitmap starts with a size byte and ffffff; the size byte says
+# how many bitmap bytes follow: 02/03 for 8x16 ("16"), 05/06 for 16x32 ("32")
+GLYPH_MARKER_SIZE = 4
+GLYPH_BITMAP_SIZES = {0x02: 16, 0x03: 16, 0x05: 64, 0x06: 64}
+
+Power = namedtuple("Power", ["on"])
+TimeSync = namedtuple("TimeSync", ["year", "month", "day", "weekday", "hour", "minute", "second"])
+# 05 00 04 80 xx; the app sends it with 10-100 from its brightness slider
+Brightness = namedtuple("Brightness", ["level"])
+Reset = namedtuple("Reset", [])
+# mode 1 is sent before a drawing session
+GraffitiMode = namedtuple("GraffitiMode", ["mode"])
+GraffitiPixel = namedtuple("GraffitiPixel", ["r", "g", "b", "x", "y", "reserved"], defaults=[0])
+UploadChunk = namedtuple("UploadChunk", ["opcode", "flag", "total_len", "crc", "trailer", "data"])
+# Anything we have no layout for, kept as is so it still round-trips
+Unknown = namedtuple("Unknown", ["opcode", "sub", "body"])
+TextMetadata = namedtuple("TextMetadata", ["chars", "mode", "speed", "colour_mode", "colour", "bg_mode", "bg_colour"])
+
+# type -> (struct, opcode, sub-opcode); the struct covers the whole packet
+FIXED = {
+    Power: (struct.Struct("<HBBB"), 0x07, 0x01),
+    TimeSync: (struct.Struct("<HBB7B"), 0x01, MIN_BYTE_VALUE),
+    Brightness: (struct.Struct("<HBBB"), 0x04, MIN_BYTE_VALUE),
+    Reset: (struct.Struct("<HBB"), 0x03, MIN_BYTE_VALUE),
+    GraffitiMode: (struct.Struct("<HBBB"), 0x04, 0x01),
+    GraffitiPixel: (struct.Struct("<HBBB5B"), 0x05, 0x01),
+}
+_BY_HEADER = {(opcode, sub, layout.size): kind for kind, (layout, opcode, sub) in FIXED.items()}
+
+def _fields(packet):
+    if isinstance(packet, GraffitiPixel):
+        # the byte after the sub-opcode comes first on the wire
+        return (packet.reserved, packet.r, packet.g, packet.b, packet.x, packet.y)
+    return tuple(int(v) for v in packet)
+
+def encoded_size(packet):
+    if isinstance(packet, UploadChunk):
+        return UPLOAD_HEADER_SIZE + len(packet.data)
+    if isinstance(packet, Unknown):
+        return PREFIX.size + len(packet.body)
+    return FIXED[type(packet)][0].size
+
+def encode_into(packet, buffer, offset=0):
+    """
+    Writes packet into buffer at offset; returns the number of bytes written.
+    """
+    size = encoded_size(packet)
+    if isinstance(packet, UploadChunk):
+        UPLOAD_HEADER.pack_into(buffer, offset, size, packet.opcode, 0, packet.flag, packet.total_len, packet.crc, bytes(packet.trailer))
+        buffer[offset + UPLOAD_HEADER_SIZE:offset + size] = packet.data
+    elif isinstance(packet, Unknown):
+        PREFIX.pack_into(buffer, offset, size, packet.opcode, packet.sub)
+        buffer[offset + PREFIX.size:offset + size] = packet.body
+    else:
+        layout, opcode, sub = FIXED[type(packet)]
+        layout.pack_into(buffer, offset, size, opcode, sub, *_fields(packet))
+    return size
+
+def encode(packet):
+    buffer = bytearray(encoded_size(packet))
+    encode_into(packet, buffer)
+    return buffer
+
+def decode(data):
+    """
+    Decodes one whole packet. Upload chunk data and unknown bodies are
+    memoryviews into data.
+    """
+    view = memoryview(data)
+    if len(view) < PREFIX.size:
+        raise Exception(f"Packet too short: {bytes(view).hex()}")
+    length, opcode, sub = PREFIX.unpack_from(view)
+    if length != len(view):
+        raise Exception(f"Packet says {length} bytes, got {len(view)}")
+    kind = _BY_HEADER.get((opcode, sub, length))
+    if kind is not None:
+        fields = FIXED[kind][0].unpack_from(view)[3:]
+        if kind is GraffitiPixel:
+            reserved, r, g, b, x, y = fields
+            return GraffitiPixel(r, g, b, x, y, reserved)
+        return kind(*fields)
+    if opcode in UPLOAD_TRAILERS and sub == 0 and length > UPLOAD_HEADER_SIZE:
+        _, _, _, flag, total_len, crc, trailer = UPLOAD_HEADER.unpack_from(view)
+        return UploadChunk(opcode, flag, total_len, crc, trailer, view[UPLOAD_HEADER_SIZE:])
+    return Unknown(opcode, sub, view[PREFIX.size:])
+
+class PacketReader:
+    """
+    Splits a stream of writes (MTU slices, or several packets in one write) back
+    into packets by their length prefix. Lengths above max_length are treated as
+    garbage, like lengths too short to be a packet.
+    """
+
+    def __init__(self, max_length=None):
+        self._buffer = bytearray()
+        self.max_length = max_length
+
+    def feed(self, data):
+        """
+        Adds data and returns the packets it completed, as bytes.
+        """
+        self._buffer += data
+        packets = []
+        while len(self._buffer) >= 2:
+            length = int.from_bytes(self._buffer[:2], "little")
+            if length < PREFIX.size or (self.max_length and length > self.max_length):
+                if packets:
+                    break # report the packets before it first, the next feed raises
+                dropped = len(self._buffer)
+                self._buffer.clear()
+                raise Exception(f"Bad packet length {length}, dropped {dropped} bytes")
+            if len(self._buffer) < length:
+                break
+            packets.append(bytes(self._buffer[:length]))
+            del self._buffer[:length]
+        return packets
+
+    def reset(self):
+        # Drops a partial packet, e.g. after a gap in the stream
+        dropped = len(self._buffer)
+        self._buffer.clear()
+        return dropped
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+# Builders for the packets the controller sends
+
+def power(on):
+    return encode(Power(1 if on else 0))
+
+def brightness(level):
+    return encode(Brightness(level))
+
+def graffiti_mode(mode=1):
+    return encode(GraffitiMode(mode))
+
+def graffiti_pixel(r, g, b, x, y):
+    return encode(GraffitiPixel(r, g, b, x, y))
+
+def time_sync(now=None):
+    t = time.localtime(now if now is not None else time.time())
+    # The Android app sends the year masked to one byte like this, the panel seems to ignore it
+    return encode(TimeSync(t.tm_year & 0xff, t.tm_mon, t.tm_mday, t.tm_wday + 1, t.tm_hour, t.tm_min, t.tm_sec))
+
+# The app's "reset": 04 00 03 80 followed by brightness 0x50
+RESET = (encode(Reset()), brightness(0x50))
+
+def text_payload(bitmaps, num_chars, text_mode=1, speed=95, text_colour_mode=1, text_colour=(255, 0, 0), text_bg_mode=0, text_bg_colour=(0, 0, 0)):
+    """
+    Text metadata followed by the character bitmaps: everything after the
+    opcode 0x03 upload header, which is what its CRC covers.
+    """
+    payload = bytearray(TEXT_METADATA_SIZE + len(bitmaps))
+    TEXT_METADATA.pack_into(payload, 0, num_chars, 0, 1, text_mode, speed, text_colour_mode, *text_colour, text_bg_mode, *text_bg_colour)
+    payload[TEXT_METADATA_SIZE:] = bitmaps
+    return payload
+
+def decode_text_metadata(payload):
+    chars, _, _, mode, speed, colour_mode, r, g, b, bg_mode, bg_r, bg_g, bg_b = TEXT_METADATA.unpack_from(payload)
+    return TextMetadata(chars, mode, speed, colour_mode, (r, g, b), bg_mode, (bg_r, bg_g, bg_b))
+
+def split_glyphs(bitmaps):
+    """
+    Splits the character bitmaps of a text payload into (size byte, bitmap
+    memoryview) per character.
+    """
+    view = memoryview(bitmaps)
+    glyphs = []
+    offset = 0
+    while offset < len(view):
+        size = view[offset]
+        if size not in GLYPH_BITMAP_SIZES or bytes(view[offset + 1:offset + GLYPH_MARKER_SIZE]) != b"\xff\xff\xff":
+            raise Exception(f"No character marker at byte {offset}: {bytes(view[offset:offset + GLYPH_MARKER_SIZE]).hex()}")
+        end = offset + GLYPH_MARKER_SIZE + GLYPH_BITMAP_SIZES[size]
+        if end > len(view):
+            raise Exception(f"Character at byte {offset} is cut off")
+        glyphs.append((size, view[offset + GLYPH_MARKER_SIZE:end]))
+        offset = end
+    return glyphs
+
+class Upload:
+    """
+    A GIF or text payload framed as upload chunk packets in one preallocated
+    buffer, [header|chunk 0][header|chunk 1]...
+
+    The payload is copied into the buffer once; packets are memoryviews into
+    it, ready to hand to the transport without another copy.
+    """
+
+    def __init__(self, opcode, payload, crc=None, chunk_size=CHUNK_SIZE):
+        size = len(payload)
+        self.opcode = opcode
+        self.payload_len = size
+        self.crc = zlib.crc32(payload) if crc is None else crc
+        # GIF totals count both 16 byte headers on top of the payload, text totals only the payload
+        self.total_len = size + 2 * UPLOAD_HEADER_SIZE if opcode == GIF_UPLOAD else size
+        starts = range(0, size, chunk_size)
+        self.buffer = bytearray(size + len(starts) * UPLOAD_HEADER_SIZE)
+        view = memoryview(self.buffer)
+        source = memoryview(payload)
+        trailer = UPLOAD_TRAILERS[opcode]
+        self.packets = []
+        offset = 0
+        for i, start in enumerate(starts):
+            chunk = source[start:start + chunk_size]
+            packet_len = UPLOAD_HEADER_SIZE + len(chunk)
+            UPLOAD_HEADER.pack_into(self.buffer, offset, packet_len, opcode, 0, MORE_CHUNKS if i else FIRST_CHUNK, self.total_len, self.crc, trailer)
+            view[offset + UPLOAD_HEADER_SIZE:offset + packet_len] = chunk
+            self.packets.append(view[offset:offset + packet_len])
+            offset += packet_len
+
+def gif_upload(gif_data, crc=None):
+    return Upload(GIF_UPLOAD, gif_data, crc)
+
+def text_upload(payload, crc=None):
+    return Upload(TEXT_UPLOAD, payload, crc)
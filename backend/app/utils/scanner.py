@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEVICE_PREFIXES = ("IDM-", "LEDnetWF")
+SCAN_WINDOW = 4.0 # seconds the radio listens per cycle
+SCAN_IDLE = 1.0 # seconds between cycles, leaves airtime for an active connection
+DEVICE_TTL = 60.0 # devices not heard from for this long drop out of devices()
+RSSI_HISTORY = 20
+PAUSE_TIMEOUT = 2.0
+
+class DeviceRecord:
+    def __init__(self, peripheral, name, address):
+        self.peripheral = peripheral
+        self.name = name
+        self.address = address
+        self.rssi_history = deque(maxlen=RSSI_HISTORY)
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+
+    def to_dict(self):
+        rssi = list(self.rssi_history)
+        return {
+            "name": self.name,
+            "address": self.address,
+            "rssi": rssi[-1] if rssi else None,
+            "rssi_avg": round(sum(rssi) / len(rssi), 1) if rssi else None,
+            "rssi_history": rssi,
+            "last_seen_s": round(time.time() - self.last_seen, 1),
+        }
+
+class BleScanner:
+    """
+    Keeps scanning in a background thread and remembers every panel it hears.
+
+    simplepyble's scan-found/scan-updated callbacks feed a registry keyed by
+    address with the peripheral handle, last-seen time and recent RSSI values,
+    so a device list is available without waiting for a scan and connect() can
+    reuse the handle instead of scanning again. The radio scans in SCAN_WINDOW
+    bursts; paused() stops it around work that should not share the radio
+    (connecting, uploads and graffiti writes).
+    """
+
+    def __init__(self, adapter, prefixes=DEVICE_PREFIXES):
+        self.adapter = adapter
+        self.prefixes = prefixes
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._pauses = 0
+        self._thread = None
+        self.cycles = 0
+        try:
+            adapter.set_callback_on_scan_found(self._on_seen)
+            adapter.set_callback_on_scan_updated(self._on_seen)
+            self._callbacks = True
+        except Exception as e:
+            # Older simplepyble builds; fall back to reading the results after every cycle
+            print(f"Scan callbacks unavailable: {e}")
+            self._callbacks = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._thread = threading.Thread(target=self._run, name="ble-scanner", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pauses:
+                    self._cond.wait()
+                self._wake.clear()
+                self._idle.clear()
+            try:
+                self.adapter.scan_start()
+                self._wake.wait(SCAN_WINDOW)
+                self.adapter.scan_stop()
+                if not self._callbacks:
+                    self._ingest(self.adapter.scan_get_results())
+                self.cycles += 1
+            except Exception as e:
+                print(f"Background scan failed: {e}")
+            finally:
+                self._idle.set()
+            time.sleep(SCAN_IDLE)
+
+    def _on_seen(self, peripheral):
+        try:
+            name = peripheral.identifier()
+            if not name.startswith(self.prefixes):
+                return
+            address = peripheral.address()
+            rssi = peripheral.rssi()
+        except Exception:
+            return
+        with self._lock:
+            record = self._devices.get(address)
+            if record is None:
+                record = self._devices[address] = DeviceRecord(peripheral, name, address)
+            else:
+                record.peripheral = peripheral
+                record.name = name
+                record.last_seen = time.time()
+            record.rssi_history.append(rssi)
+
+    def _ingest(self, peripherals):
+        for p in peripherals:
+            self._on_seen(p)
+
+    def scan_once(self, timeout_ms):
+        """
+        Blocking scan for when the background thread is not running (or a device
+        we need has not shown up yet).
+        """
+        with self.paused():
+            self.adapter.scan_for(timeout_ms)
+            self._ingest(self.adapter.scan_get_results())
+
+    @contextmanager
+    def paused(self):
+        with self._cond:
+            self._pauses += 1
+        self._wake.set()
+        if not self._idle.wait(PAUSE_TIMEOUT):
+            print("Background scan did not stop in time")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._pauses -= 1
+                self._cond.notify_all()
+
+    def peripheral(self, address):
+        with self._lock:
+            record = self._devices.get(address)
+            return record.peripheral if record else None
+
+    def devices(self, max_age=DEVICE_TTL):
+        cutoff = time.time() - max_age
+        with self._lock:
+            records = [r.to_dict() for r in self._devices.values() if r.last_seen >= cutoff]
+        return sorted(records, key=lambda d: d["rssi"] if d["rssi"] is not None else -999, reverse=True)
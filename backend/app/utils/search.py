@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+SEARCH_TTL = float(os.environ.get("IDM_SEARCH_TTL", 600))
+SEARCH_CACHE_SIZE = 128
+SEARCH_MAX_RESULTS = 50
+# How many of the top results get downloaded and converted ahead of a click
+PREFETCH_COUNT = int(os.environ.get("IDM_PREFETCH_COUNT", 8))
+PREFETCH_WORKERS = 2
+PREFETCH_SEEN = 256 # prefetched URLs remembered so repeated searches skip them
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+def duckduckgo_images(query, max_results=SEARCH_MAX_RESULTS):
+    """
+    Default upstream: DuckDuckGo image search (no API key required).
+    Returns a list of {"title", "url", "thumbnail"}.
+    """
+    from duckduckgo_search import DDGS
+    results = []
+    with DDGS() as ddgs:
+        for img in ddgs.images(f"{query} pixel art", max_results=max_results, type_image="gif"):
+            results.append({
+                "title": img.get("title", ""),
+                "url": img.get("image", ""),
+                "thumbnail": img.get("thumbnail", "")
+            })
+    return results
+
+class SearchService:
+    """
+    Image search with a TTL + LRU result cache keyed by the normalized query.
+
+    submit() returns a concurrent Future so routes can await it without blocking
+    the event loop; identical queries that arrive while one is in flight share
+    its Future instead of calling the upstream again. After a fresh search the
+    top PREFETCH_COUNT images are downloaded with fetch(url) and handed to
+    prefetch(source_bytes) in the background, which is meant to warm the
+    conversion cache. The bytes are not kept here; fetch is expected to cache
+    them itself (Downloader does, bounded and revalidated). upstream(query) can be any callable returning result
+    dicts, e.g. a local stand-in for tests.
+    """
+
+    def __init__(self, upstream=duckduckgo_images, fetch=None, prefetch=None, ttl=SEARCH_TTL,
+                 max_entries=SEARCH_CACHE_SIZE, prefetch_count=PREFETCH_COUNT):
+        self.upstream = upstream
+        self.fetch = fetch
+        self.prefetch = prefetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefetch_count = prefetch_count
+        self._results = OrderedDict() # query -> (expires_at, results)
+        self._in_flight = {}
+        self._prefetched_urls = OrderedDict() # url -> None, most recent last
+        self._prefetching = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search")
+        self._prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.prefetched = 0
+
+    def submit(self, query):
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._results.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(entry[1])
+                return future
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+            self.misses += 1
+            future = self._executor.submit(self._search, key)
+            self._in_flight[key] = future
+        # Outside the lock: the callback runs right away if the search already finished
+        future.add_done_callback(lambda f: self._finished(key, f))
+        return future
+
+    def _finished(self, key, future):
+        # Finished, failed or cancelled, the next submit must not get this Future again
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def search(self, query):
+        return self.submit(query).result()
+
+    def _search(self, key):
+        # Failures are not cached, the next request tries again
+        results = self.upstream(key)
+        with self._lock:
+            self._results[key] = (time.monotonic() + self.ttl, results)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        self._schedule_prefetch(results)
+        return results
+
+    def _schedule_prefetch(self, results):
+        if not self.fetch or not self.prefetch:
+            return
+        for result in results[:self.prefetch_count]:
+            url = result.get("url")
+            with self._lock:
+                if not url or url in self._prefetched_urls or url in self._prefetching:
+                    continue
+                self._prefetching.add(url)
+            self._prefetcher.submit(self._prefetch, url)
+
+    def _prefetch(self, url):
+        try:
+            self.prefetch(self.fetch(url))
+            with self._lock:
+                self._prefetched_urls[url] = None
+                while len(self._prefetched_urls) > PREFETCH_SEEN:
+                    self._prefetched_urls.popitem(last=False)
+                self.prefetched += 1
+        except Exception as e:
+            # Broken links are common in search results, a failed prefetch only costs the head start
+            print(f"Prefetch failed for {url}: {e}")
+        finally:
+            with self._lock:
+                self._prefetching.discard(url)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "deduplicated": self.deduplicated,
+                "cached_queries": len(self._results),
+                "in_flight": len(self._in_flight),
+                "prefetched": self.prefetched,
+                "prefetching": len(self._prefetching),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._prefetcher.shutdown(wait=False, cancel_futures=True)
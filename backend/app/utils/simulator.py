@@ -0,0 +1,325 @@
+import io
+import os
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from PIL import Image
+import numpy as np
+from app.utils.image_convert import PANEL_SIZE
+from app.utils.transport import ATT_HEADER_SIZE
+from app.utils import protocol
+
+# IDM_SIMULATOR=<n> replaces the Bluetooth adapter with n simulated panels
+SIM_PANELS = int(os.environ.get("IDM_SIMULATOR", 0))
+SIM_MTU = int(os.environ.get("IDM_SIM_MTU", 247))
+SIM_LINK_BPS = int(os.environ.get("IDM_SIM_BPS", 20000)) # payload bytes per second over the air
+SIM_LATENCY = float(os.environ.get("IDM_SIM_LATENCY", 0.015)) # one connection interval, paid by every write_request
+SIM_TX_BUFFER = 16 # write_command slices the host queues before write_command blocks
+
+class SimulatedPanel:
+    """
+    An in-process panel with the same interface as a simplepyble Peripheral.
+
+    Writes go through a modelled link: slices are delivered in order by a
+    background thread at link_bps, write_command refuses anything longer than
+    the MTU allows and blocks once SIM_TX_BUFFER slices are queued, and
+    write_request returns one connection interval after its data is delivered.
+    Delivered bytes are split back into packets by their length prefix and
+    parsed like the panel would: chunked GIF (0x01) and text (0x03) uploads are
+    reassembled and checked against the length and CRC in their headers and
+    acknowledged with notifications, graffiti pixels are painted on a canvas,
+    and power, brightness, time sync and reset change the panel state.
+    """
+
+    def __init__(self, name, address, mtu=SIM_MTU, link_bps=SIM_LINK_BPS, latency=SIM_LATENCY):
+        self._name = name
+        self._address = address
+        self._mtu = mtu
+        self.link_bps = link_bps
+        self.latency = latency
+        self.connected = False
+        self._callback = None
+        self._link = deque() # (delivery time, data, done event)
+        self._link_free = 0.0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._rx = protocol.PacketReader()
+        self._transfer = None
+
+        self.power = True
+        self.brightness = None
+        self.mode = "clock"
+        self.shown = None
+        self.clock = None
+        self.canvas = np.zeros((PANEL_SIZE[1], PANEL_SIZE[0], 3), dtype=np.uint8)
+        self.packets = 0
+        self.writes = 0
+        self.requests = 0 # writes that waited for a response
+        self.bytes_received = 0
+        self.transfers = 0
+        self.errors = []
+
+    # simplepyble.Peripheral interface
+
+    def identifier(self):
+        return self._name
+
+    def address(self):
+        return self._address
+
+    def rssi(self):
+        return -55 + random.randint(-4, 4)
+
+    def mtu(self):
+        return self._mtu
+
+    def is_connected(self):
+        return self.connected
+
+    def connect(self):
+        time.sleep(self.latency)
+        self.connected = True
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._deliver, name=f"sim-{self._address}", daemon=True)
+            self._thread.start()
+
+    def disconnect(self):
+        self.connected = False
+        self._callback = None
+        with self._cond:
+            self._cond.notify_all()
+
+    def notify(self, service_uuid, characteristic_uuid, callback):
+        self._callback = callback
+
+    def write_request(self, service_uuid, characteristic_uuid, data):
+        # Long writes are allowed, the stack splits them up; the time is the same
+        self.requests += 1
+        self._queue(data).wait()
+        time.sleep(self.latency)
+
+    def write_command(self, service_uuid, characteristic_uuid, data):
+        if len(data) > self._mtu - ATT_HEADER_SIZE:
+            raise Exception(f"{len(data)} byte write without response does not fit MTU {self._mtu}")
+        self._queue(data)
+
+    # Link model
+
+    def _queue(self, data):
+        if not self.connected:
+            raise Exception("Peripheral is not connected")
+        done = threading.Event()
+        self.writes += 1
+        with self._cond:
+            while len(self._link) >= SIM_TX_BUFFER and self.connected:
+                self._cond.wait()
+            self._link_free = max(time.perf_counter(), self._link_free) + (len(data) + ATT_HEADER_SIZE) / self.link_bps
+            self._link.append((self._link_free, bytes(data), done))
+            self._cond.notify_all()
+        return done
+
+    def _deliver(self):
+        while True:
+            with self._cond:
+                while not self._link and self.connected:
+                    self._cond.wait()
+                if not self._link:
+                    return
+                at, data, done = self._link[0]
+            delay = at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._receive(data)
+            except Exception as e:
+                self._error(f"Panel crashed on {data[:16].hex()}: {e}")
+            with self._cond:
+                self._link.popleft()
+                self._cond.notify_all()
+            done.set()
+
+    def _notify(self, data):
+        if self._callback:
+            self._callback(data)
+
+    def _error(self, message):
+        print(f"[{self._name}] {message}")
+        self.errors.append(message)
+        del self.errors[:-20]
+
+    # Protocol
+
+    def _receive(self, data):
+        self.bytes_received += len(data)
+        try:
+            packets = self._rx.feed(data)
+        except Exception as e:
+            self._error(str(e))
+            return
+        for packet in packets:
+            self.packets += 1
+            self._handle(packet)
+
+    def _handle(self, packet):
+        decoded = protocol.decode(packet)
+        if isinstance(decoded, protocol.UploadChunk):
+            self._chunk(decoded)
+        elif isinstance(decoded, protocol.TimeSync):
+            self.clock = decoded._asdict()
+        elif isinstance(decoded, protocol.Power):
+            self.power = bool(decoded.on)
+        elif isinstance(decoded, protocol.GraffitiMode):
+            self.mode = "graffiti"
+            self.shown = None
+            self.canvas[:] = 0
+        elif isinstance(decoded, protocol.GraffitiPixel):
+            if self.mode != "graffiti":
+                self._error("Graffiti pixel outside graffiti mode")
+                return
+            if decoded.x >= PANEL_SIZE[0] or decoded.y >= PANEL_SIZE[1]:
+                self._error(f"Graffiti pixel outside the panel: {decoded.x},{decoded.y}")
+                return
+            self.canvas[decoded.y, decoded.x] = (decoded.r, decoded.g, decoded.b)
+        elif isinstance(decoded, protocol.Reset):
+            self.mode = "clock"
+            self.shown = None
+        elif isinstance(decoded, protocol.Brightness):
+            self.brightness = decoded.level
+        else:
+            self._error(f"Unknown packet {packet.hex()}")
+
+    def _chunk(self, chunk):
+        opcode, crc = chunk.opcode, chunk.crc
+        if chunk.flag == protocol.FIRST_CHUNK:
+            if self._transfer is not None:
+                self._error("Upload abandoned before its last chunk")
+            # GIF headers count both 16 byte headers in the total, text headers only the payload
+            expected = chunk.total_len - 2 * protocol.UPLOAD_HEADER_SIZE if opcode == protocol.GIF_UPLOAD else chunk.total_len
+            self._transfer = {"opcode": opcode, "expected": expected, "crc": crc, "data": bytearray()}
+        elif self._transfer is None or self._transfer["opcode"] != opcode or self._transfer["crc"] != crc:
+            self._error("Continuation chunk without a matching first chunk")
+            self._transfer = None
+            return
+        transfer = self._transfer
+        transfer["data"] += chunk.data
+        if len(transfer["data"]) < transfer["expected"]:
+            self._notify(protocol.CHUNK_ACK)
+            return
+
+        self._transfer = None
+        data = bytes(transfer["data"])
+        if len(data) != transfer["expected"]:
+            self._error(f"Upload of {len(data)} bytes, header announced {transfer['expected']}")
+            return
+        if zlib.crc32(data) != crc:
+            self._error(f"CRC mismatch: header {crc:08x}, payload {zlib.crc32(data):08x}")
+            return
+        try:
+            shown = self._show_gif(data) if opcode == protocol.GIF_UPLOAD else self._show_text(data)
+        except Exception as e:
+            self._error(f"Rejected payload: {e}")
+            return
+        self.shown = dict(shown, bytes=len(data), crc=f"{crc:08x}")
+        self.transfers += 1
+        self._notify(protocol.TRANSFER_DONE)
+
+    def _show_gif(self, data):
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format != "GIF":
+                raise Exception(f"expected a GIF, got {img.format}")
+            if img.size != PANEL_SIZE:
+                raise Exception(f"expected a {PANEL_SIZE[0]}x{PANEL_SIZE[1]} GIF, got {img.size}")
+            frames = getattr(img, "n_frames", 1)
+        self.mode = "gif"
+        return {"frames": frames}
+
+    def _show_text(self, data):
+        meta = protocol.decode_text_metadata(data)
+        glyphs = protocol.split_glyphs(memoryview(data)[protocol.TEXT_METADATA_SIZE:])
+        if len(glyphs) != meta.chars:
+            raise Exception(f"Header says {meta.chars} characters, got {len(glyphs)}")
+        self.mode = "text"
+        return {"chars": meta.chars, "text_mode": meta.mode, "speed": meta.speed, "colour": list(meta.colour)}
+
+    def airtime(self, link_bps=SIM_LINK_BPS, latency=SIM_LATENCY):
+        """
+        Seconds everything written so far takes on a link with these settings:
+        every write on the air plus one connection interval per write_request.
+        """
+        return (self.bytes_received + self.writes * ATT_HEADER_SIZE) / link_bps + self.requests * latency
+
+    def state(self):
+        return {
+            "name": self._name,
+            "address": self._address,
+            "connected": self.connected,
+            "power": self.power,
+            "brightness": self.brightness,
+            "mode": self.mode,
+            "shown": self.shown,
+            "clock": self.clock,
+            "lit_pixels": int(self.canvas.any(axis=2).sum()) if self.mode == "graffiti" else None,
+            "packets": self.packets,
+            "writes": self.writes,
+            "requests": self.requests,
+            "bytes_received": self.bytes_received,
+            "transfers": self.transfers,
+            "errors": list(self.errors),
+        }
+
+class SimulatedAdapter:
+    """
+    Stands in for a simplepyble Adapter and advertises `count` SimulatedPanels,
+    so the backend runs (and can be load tested) without Bluetooth hardware.
+    Extra keyword arguments are passed on to every panel.
+    """
+
+    def __init__(self, count=1, **panel_options):
+        self.panels = [
+            SimulatedPanel(f"IDM-SIM{i:02d}", f"5A:1D:00:00:{i >> 8:02X}:{i & 0xff:02X}", **panel_options)
+            for i in range(count)
+        ]
+        self._on_found = None
+        self._active = False
+
+    def identifier(self):
+        return "simulator"
+
+    def address(self):
+        return "00:00:00:00:00:00"
+
+    def set_callback_on_scan_found(self, callback):
+        self._on_found = callback
+
+    def set_callback_on_scan_updated(self, callback):
+        self._on_found = self._on_found or callback
+
+    def set_callback_on_scan_start(self, callback):
+        pass
+
+    def set_callback_on_scan_stop(self, callback):
+        pass
+
+    def scan_start(self):
+        self._active = True
+        for panel in self.panels:
+            if self._on_found:
+                self._on_found(panel)
+
+    def scan_stop(self):
+        self._active = False
+
+    def scan_is_active(self):
+        return self._active
+
+    def scan_for(self, timeout_ms):
+        self.scan_start()
+        self.scan_stop()
+
+    def scan_get_results(self):
+        return list(self.panels)
+
+    def states(self):
+        return [panel.state() for panel in self.panels]
@@ -1,10 +1,13 @@
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import io
+import numpy as np
+from app.utils.fonts import font_registry, glyph_cache, SCROLL_FONT_SIZE
 
-def create_scrolling_text_gif(text, text_color=(255, 255, 255), active: bool = True):
+def create_scrolling_text_gif(text, text_color=(255, 255, 255), active: bool = True, delta: bool = False):
     """
     Generates a 32x32 scrolling text GIF.
+    With delta=True only the changed part of each frame is stored (see gif_delta).
     Returns bytes of the GIF.
     """
     # Constants
@@ -12,12 +15,8 @@ def create_scrolling_text_gif(text, text_color=(255, 255, 255), active: bool = T
     FONT_SIZE = 16 # Fallback if font file issues, though we load default usually or specific
     SCROLL_SPEED = 2 # Pixels per frame
     
-    # Create font
-    try:
-        # Try a blocky font if available, or default
-        font = ImageFont.truetype("arial.ttf", 24) 
-    except IOError:
-        font = ImageFont.load_default()
+    # Loaded once by the font registry, falls back to the default font
+    font = font_registry.get("scroll", SCROLL_FONT_SIZE)
         
     # Calculate text size
     # Create dummy image to measure
@@ -43,36 +42,47 @@ def create_scrolling_text_gif(text, text_color=(255, 255, 255), active: bool = T
         return out_io.getvalue()
         
     # If text is larger, scroll it
-    else:
-        frames = []
-        # Total movement: start off screen right, move all the way to off screen left?
-        # Standard marquee: Start with text just appearing on right, scroll until it disappears on left
-        # Or Just scroll content through
-        
-        # Let's do: Start at x=32, end at x=-text_width
-        total_distance = WIDTH + text_width
-        
-        for x_offset in range(WIDTH, -text_width, -2): # Scroll step 2
-             img = Image.new('RGB', (WIDTH, HEIGHT), (0, 0, 0))
-             draw = ImageDraw.Draw(img)
-             
-             # Draw text at offset
-             y_centered = (HEIGHT - text_height) // 2
-             draw.text((x_offset, y_centered), text, font=font, fill=text_color)
-             
-             # Convert to P mode for GIF
-             frames.append(img.convert('P', palette=Image.Palette.ADAPTIVE))
-             
-        out_io = io.BytesIO()
-        if not frames: return b''
-        
-        frames[0].save(
-            out_io, 
-            format='GIF', 
-            save_all=True, 
-            append_images=frames[1:], 
-            loop=0, 
-            duration=100, # 100ms per frame
-            disposal=2
-        )
-        return out_io.getvalue()
+    # Standard marquee: start with the text just off screen right and scroll until
+    # it has left on the left. The text is drawn once into a strip with one blank
+    # screen on either side and every frame is a 32 px window into it.
+    strip = Image.new('P', (WIDTH + text_width + WIDTH, HEIGHT), 0)
+    # Fixed two colour palette: 0 is black, 1 the text colour. Drawing into a P
+    # image renders the glyphs without antialiasing, so no other colours appear.
+    palette = [0, 0, 0, *text_color]
+    strip.putpalette(palette)
+    y_centered = (HEIGHT - text_height) // 2
+    ImageDraw.Draw(strip).text((WIDTH, y_centered), text, font=font, fill=1)
+    pixels = np.asarray(strip)
+
+    frames = []
+    for x_offset in range(WIDTH, -text_width, -SCROLL_SPEED):
+        start = WIDTH - x_offset
+        # The column slice is not contiguous, fromarray copies it: 1 KB per frame, not the strip
+        frame = Image.fromarray(pixels[:, start:start + WIDTH])
+        frame.putpalette(palette)
+        frames.append(frame.convert('RGB') if delta else frame)
+
+    if not frames: return b''
+    if delta:
+        from app.utils.gif_delta import encode_delta_gif
+        return encode_delta_gif(frames, [100] * len(frames))
+
+    out_io = io.BytesIO()
+    frames[0].save(
+        out_io,
+        format='GIF',
+        save_all=True,
+        append_images=frames[1:],
+        loop=0,
+        duration=100, # 100ms per frame
+        disposal=2,
+        palette=palette, # one global colour table instead of one per frame
+    )
+    return out_io.getvalue()
+
+def render_text_bitmaps(text, font_path=None):
+    """
+    Returns the 05ffffff marker plus a 64-byte 16x32 bitmap for every character,
+    ready for the native text command. Glyphs come from the shared glyph cache.
+    """
+    return glyph_cache.render(text, font_path or "glyph")
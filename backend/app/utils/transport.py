@@ -0,0 +1,77 @@
+
+import os
+
+ATT_HEADER_SIZE = 3 # opcode + attribute handle, taken out of every ATT packet
+DEFAULT_MTU = 23 # BLE minimum, used when the peripheral can't report its MTU
+# write_command slices in flight before a write_request waits for the panel; lower
+# it for panels or adapters that drop slices, raise it on a fast, clean link
+DEFAULT_WINDOW = int(os.environ.get("IDM_STREAM_WINDOW", 8))
+
+class BleTransport:
+    """
+    Writes protocol packets to one characteristic of a connected peripheral.
+
+    Packets that fit in a single ATT payload go out with write_request as before.
+    Larger packets (the 4 KB image chunks) are split into MTU-sized slices and
+    streamed with write_command. Every `window`-th slice is sent as a write_request
+    instead, which only returns once the panel has processed everything queued
+    before it, so at most `window` slices are ever in flight. write_many applies
+    the same window to a run of small packets.
+    """
+
+    def __init__(self, peripheral, service_uuid, characteristic_uuid, window=DEFAULT_WINDOW, use_write_command=True):
+        self.peripheral = peripheral
+        self.service_uuid = service_uuid
+        self.characteristic_uuid = characteristic_uuid
+        self.window = max(1, window)
+        self.use_write_command = use_write_command
+        self.mtu = self._read_mtu()
+        self.slice_size = self.mtu - ATT_HEADER_SIZE
+        self.slices_written = 0
+
+    def _read_mtu(self):
+        try:
+            mtu = self.peripheral.mtu()
+        except Exception as e:
+            print(f"Could not read MTU, assuming {DEFAULT_MTU}: {e}")
+            return DEFAULT_MTU
+        return mtu if mtu and mtu > ATT_HEADER_SIZE else DEFAULT_MTU
+
+    def write(self, packet):
+        if len(packet) <= self.slice_size or not self.use_write_command:
+            self.peripheral.write_request(self.service_uuid, self.characteristic_uuid, bytes(packet))
+            self.slices_written += 1
+            return
+        self.stream(packet)
+
+    def stream(self, packet):
+        view = memoryview(packet)
+        self._pipeline([view[offset:offset + self.slice_size] for offset in range(0, len(view), self.slice_size)])
+
+    def write_many(self, packets):
+        """
+        Sends a run of small packets (graffiti pixels) back to back with the same
+        windowing as stream, instead of waiting for a response after each one.
+        """
+        self._pipeline(packets)
+
+    def _pipeline(self, parts):
+        in_flight = 0
+        for i, part in enumerate(parts):
+            data = bytes(part)
+            last = i == len(parts) - 1
+            in_flight += 1
+            if in_flight >= self.window or last or not self.use_write_command:
+                # Synchronous write closes the window: it is answered only after
+                # the slices queued ahead of it have been delivered.
+                self.peripheral.write_request(self.service_uuid, self.characteristic_uuid, data)
+                in_flight = 0
+            else:
+                try:
+                    self.peripheral.write_command(self.service_uuid, self.characteristic_uuid, data)
+                except Exception as e:
+                    # Characteristic or backend without write-without-response support
+                    print(f"write_command failed, falling back to write_request: {e}")
+                    self.use_write_command = False
+                    self.peripheral.write_request(self.service_uuid, self.characteristic_uuid, data)
+            self.slices_written += 1
@@ -0,0 +1,57 @@
+"""
+Compares the per-frame Pillow conversion path with the NumPy batch engine on the
+GIFs in assets_test/.
+
+    cd backend
+    python -m benchmarks.frame_engines [--repeat 5]
+"""
+import argparse
+import glob
+import os
+import time
+from app.utils import image_convert, numpy_engine
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "assets_test")
+
+def best_of(func, source, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--assets", default=ASSETS_DIR)
+    args = parser.parse_args()
+
+    engines = {
+        "pillow": lambda src: image_convert.encode_gif(*image_convert.render_frames(src)),
+        "numpy": lambda src: image_convert.encode_gif(*numpy_engine.render_frames(src)),
+    }
+    totals = {name: 0.0 for name in engines}
+    print(f"{'file':<36} {'frames':>6} {'pillow ms':>10} {'numpy ms':>10} {'speedup':>8} {'bytes p/n':>14}")
+    for path in sorted(glob.glob(os.path.join(args.assets, "*.gif"))):
+        with open(path, "rb") as f:
+            source = f.read()
+        try:
+            n_frames = image_convert.frame_count(source)
+            results = {name: best_of(func, source, args.repeat) for name, func in engines.items()}
+        except OSError as e:
+            print(f"{os.path.basename(path):<36} skipped: {e}")
+            continue
+        for name, (elapsed, _) in results.items():
+            totals[name] += elapsed
+        p_time, p_out = results["pillow"]
+        n_time, n_out = results["numpy"]
+        print(f"{os.path.basename(path)[:36]:<36} {n_frames:>6} {p_time * 1000:>10.1f} {n_time * 1000:>10.1f} "
+              f"{p_time / n_time:>7.2f}x {len(p_out):>6}/{len(n_out):<7}")
+    print(f"{'total':<36} {'':>6} {totals['pillow'] * 1000:>10.1f} {totals['numpy'] * 1000:>10.1f} "
+          f"{totals['pillow'] / totals['numpy']:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks for the upload path.
+
+Every GIF in assets_test/ goes through convert_image_to_32x32, a few strings
+through the text generators (app.utils.text_gen and the legacy
+idotmatrix_controller.py), and every result is sent with send_image /
+send_text to a simulated panel (see app/utils/simulator.py), which checks the
+packets and counts what went over the air. delta/long-hold encodes a still
+frame held for longer than one GIF delay can store and fails unless the result
+plays for as long as its source, and the budget/* cases do the same for
+convert_to_budget at a few byte budgets. The captured app sessions in
+btsnoop/ are decoded and replayed to the simulated panel as fast as it takes
+them (tools/capture_replay.py); for those convert_ms is the decode time.
+
+For each case it records:
+  convert_ms    median conversion time over --repeat runs, caches cleared
+  peak_kib      peak Python memory during one conversion after WARMUP_RUNS
+                untraced ones (tracemalloc, Pillow's own image buffers are not
+                included)
+  output_bytes  payload size
+  chunks        4 KB upload chunks
+  transfer_s    modelled BLE transfer time at IDM_SIM_BPS / IDM_SIM_LATENCY
+
+Results are written to results.json next to this file and compared with
+baseline.json; the exit status is 1 when any metric got worse than THRESHOLDS
+allow. Run from backend/:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --only Fire --repeat 5
+    python benchmarks/run_benchmarks.py --update-baseline
+"""
+import argparse
+import contextlib
+import gc
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+REPO_DIR = os.path.dirname(BACKEND_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(1, REPO_DIR)
+sys.path.insert(2, os.path.join(REPO_DIR, "tools"))
+
+# No Bluetooth here: the app's module-level controller gets a simulated panel too
+os.environ.setdefault("IDM_SIMULATOR", "1")
+
+from app.utils.idotmatrix import IDotMatrix, build_text_payload, WRITE_CMD_UUID, SERVICE_UUID
+from app.utils.image_cache import ConvertedImageCache
+from app.utils.convert_pool import ConversionPipeline
+from app.utils.simulator import SimulatedAdapter, SIM_LINK_BPS, SIM_LATENCY
+from app.utils.fonts import glyph_cache
+from app.utils import text_gen, gif_delta
+from PIL import Image, ImageSequence
+import idotmatrix_controller as legacy
+import capture_replay
+
+ASSETS = os.path.join(REPO_DIR, "assets_test")
+CAPTURES = os.path.join(REPO_DIR, "btsnoop")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+RESULTS = os.path.join(BENCH_DIR, "results.json")
+TEXTS = {
+    "short": "Hi",
+    "sentence": "It's Christmas!",
+    "long": "The quick brown fox jumps over the lazy dog. " * 4,
+}
+# (asset, max_bytes) for convert_to_budget
+BUDGETS = [
+    ("Fire.gif", 3000),
+    ("Fire.gif", 1200),
+    ("fireplace_from_app.gif", 1800),
+    ("fireplace_from_app.gif", 1000),
+]
+# The simulated link runs flat out while benchmarking; transfer_s is modelled afterwards
+FAST_LINK = {"link_bps": 10 ** 9, "latency": 0}
+
+# Untraced conversions before the one peak_kib is measured on
+WARMUP_RUNS = 1
+
+# metric: (allowed relative increase, increases up to this much are ignored)
+THRESHOLDS = {
+    "convert_ms": (0.50, 5.0), # wall time is noisy, only big slowdowns count
+    "peak_kib": (0.25, 64),
+    "output_bytes": (0.02, 0),
+    "chunks": (0.0, 0),
+    "transfer_s": (0.02, 0.01),
+}
+
+def make_panel():
+    adapter = SimulatedAdapter(1, **FAST_LINK)
+    panel = IDotMatrix(adapter=adapter)
+    # Convert in this process so tracemalloc sees it and timings don't include pickling
+    panel.converter = ConversionPipeline(workers=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        panel.connect(adapter.panels[0].address())
+    return panel
+
+def measure(convert, repeat):
+    # The peak is taken before the timed runs, after the same warm-up whatever
+    # --repeat is, so it stays comparable with the baseline
+    for _ in range(WARMUP_RUNS):
+        convert()
+    gc.collect()
+    tracemalloc.start()
+    convert()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = convert()
+        times.append(time.perf_counter() - started)
+    return {
+        "convert_ms": round(statistics.median(times) * 1000, 2),
+        "peak_kib": round(peak / 1024, 1),
+    }, result
+
+def transfer(panel, send):
+    sim = panel.peripheral
+    before = sim.airtime(SIM_LINK_BPS, SIM_LATENCY)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = send()
+    if sim.errors:
+        raise Exception(f"Simulated panel rejected the upload: {sim.errors[-1]}")
+    return {
+        "chunks": stats["chunks"] if stats else 1,
+        "transfer_s": round(sim.airtime(SIM_LINK_BPS, SIM_LATENCY) - before, 3),
+    }
+
+def bench_gif(path, repeat):
+    with open(path, "rb") as f:
+        source = f.read()
+    panel = make_panel()
+
+    def convert():
+        panel.image_cache = ConvertedImageCache(directory=None)
+        return panel.convert_image_to_32x32(io.BytesIO(source))
+
+    metrics, data = measure(convert, repeat)
+    metrics["output_bytes"] = len(data)
+    metrics.update(transfer(panel, lambda: panel.send_image(data, force=True)))
+    return metrics
+
+def check_playback(data, durations):
+    # Raises unless the GIF decodes and plays for exactly as long as its source frames
+    with Image.open(io.BytesIO(data)) as im:
+        played = sum(frame.info.get("duration", 0) for frame in ImageSequence.Iterator(im))
+    if played != sum(durations):
+        raise Exception(f"GIF plays for {played} ms instead of {sum(durations)} ms")
+
+def bench_long_hold(hold_frames, repeat):
+    # A still frame shown far longer than one GIF delay can hold, between two short ones
+    colours = [(255, 0, 0)] + [(0, 0, 255)] * hold_frames + [(0, 255, 0)]
+    frames = [Image.new("RGB", (32, 32), colour) for colour in colours]
+    durations = [100] + [655270] * hold_frames + [100]
+    panel = make_panel()
+    metrics, data = measure(lambda: gif_delta.encode_delta_gif(frames, durations), repeat)
+    check_playback(data, durations)
+    metrics["output_bytes"] = len(data)
+    metrics.update(transfer(panel, lambda: panel.send_image(data, force=True)))
+    return metrics
+
+def bench_budget(arg, repeat):
+    path, max_bytes = arg
+    with open(path, "rb") as f:
+        source = f.read()
+    with Image.open(io.BytesIO(source)) as im:
+        durations = [frame.info.get("duration", 0) for frame in ImageSequence.Iterator(im)]
+    panel = make_panel()
+    metrics, (payload, settings) = measure(lambda: panel.convert_to_budget(io.BytesIO(source), max_bytes=max_bytes), repeat)
+    check_playback(payload.data, durations)
+    metrics["output_bytes"] = len(payload.data)
+    metrics["frames"] = settings["frames"]
+    metrics.update(transfer(panel, lambda: panel.send_image(payload.data, force=True)))
+    return metrics
+
+def bench_native_text(text, repeat):
+    panel = make_panel()
+
+    def convert():
+        glyph_cache.clear()
+        return build_text_payload(text_gen.render_text_bitmaps(text), len(text))
+
+    metrics, payload = measure(convert, repeat)
+    metrics["output_bytes"] = len(payload)
+    metrics.update(transfer(panel, lambda: panel.send_text(text, force=True)))
+    return metrics
+
+def bench_scrolling_text(text, repeat):
+    panel = make_panel()
+    metrics, data = measure(lambda: text_gen.create_scrolling_text_gif(text), repeat)
+    metrics["output_bytes"] = len(data)
+    metrics.update(transfer(panel, lambda: panel.send_image(data, force=True)))
+    return metrics
+
+def bench_legacy_text(text, repeat):
+    panel = make_panel()
+
+    def convert():
+        glyph_cache.clear()
+        return legacy.build_string_packet(legacy.string_to_bitmaps(text))
+
+    metrics, packet = measure(convert, repeat)
+    metrics["output_bytes"] = len(packet)
+    # The script writes the whole text packet in one write_request, unchunked
+    sim = panel.peripheral
+    metrics.update(transfer(panel, lambda: sim.write_request(SERVICE_UUID, WRITE_CMD_UUID, bytes(packet))))
+    return metrics
+
+def bench_capture(path, repeat):
+    metrics, records = measure(lambda: list(capture_replay.decode(path)), repeat)
+    metrics["output_bytes"] = sum(len(r.data) for r in records if isinstance(r, capture_replay.Packet))
+    panel = make_panel()
+    sim = panel.peripheral
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = capture_replay.replay(panel, records, fast=True)
+    # The app sends opcodes the simulator does not know, so its errors are not checked here
+    metrics["chunks"] = summary["chunks"]
+    metrics["transfer_s"] = round(sim.airtime(SIM_LINK_BPS, SIM_LATENCY), 3)
+    return metrics
+
+def cases():
+    for path in sorted(glob.glob(os.path.join(ASSETS, "*.gif"))):
+        yield f"gif/{os.path.basename(path)}", bench_gif, path
+    yield "delta/long-hold", bench_long_hold, 40
+    for name, max_bytes in BUDGETS:
+        yield f"budget/{name}@{max_bytes}", bench_budget, (os.path.join(ASSETS, name), max_bytes)
+    for name, text in TEXTS.items():
+        yield f"text/native/{name}", bench_native_text, text
+        yield f"text/scroll/{name}", bench_scrolling_text, text
+        yield f"text/legacy/{name}", bench_legacy_text, text
+    for path in sorted(glob.glob(os.path.join(CAPTURES, "*.pcapng"))):
+        yield f"capture/{os.path.basename(path)}", bench_capture, path
+
+def run(repeat, only=None):
+    results = {}
+    for name, bench, arg in cases():
+        if only and only not in name:
+            continue
+        try:
+            results[name] = bench(arg, repeat)
+        except Exception as e:
+            # A broken asset is recorded, not fatal; it only counts if it used to work
+            results[name] = {"error": str(e)}
+        print(f"{name:48} {format_metrics(results[name])}")
+    return results
+
+def format_metrics(metrics):
+    if "error" in metrics:
+        return f"error: {metrics['error']}"
+    return "  ".join(f"{k}={v}" for k, v in metrics.items())
+
+def compare(results, baseline):
+    """
+    Returns a list of human readable regressions of results against baseline.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if "error" in metrics:
+            if "error" not in old:
+                regressions.append(f"{name}: now fails ({metrics['error']})")
+            continue
+        for metric, (relative, absolute) in THRESHOLDS.items():
+            if metric not in metrics or metric not in old:
+                continue
+            new_value, old_value = metrics[metric], old[metric]
+            if new_value > old_value * (1 + relative) and new_value - old_value > absolute:
+                change = f"+{(new_value / old_value - 1) * 100:.0f}%" if old_value else "new"
+                regressions.append(f"{name}: {metric} {old_value} -> {new_value} ({change})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=3, help="conversion runs per case, the median is kept")
+    parser.add_argument("--only", help="only run cases whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--output", default=RESULTS)
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args()
+
+    results = run(max(1, args.repeat), args.only)
+    report = {
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "link": {"bps": SIM_LINK_BPS, "latency_s": SIM_LATENCY},
+        "cases": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline yet, run with --update-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["cases"]
+    regressions = compare(results, baseline)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nNo regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -117,7 +117,7 @@ export default function ImageController({ isConnected }: { isConnected: boolean
             const file = new File([blob], "edited_upload.png", { type: "image/png" });
             const result = await api.upload(file);
 
-            if (result.status === "uploaded") {
+            if (result.status === "uploaded" || result.status === "queued") {
                 setStatus(t("sentSuccess"));
                 setTimeout(() => setStatus(null), 3000);
             } else {
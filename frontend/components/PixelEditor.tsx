@@ -19,13 +19,38 @@ export default function PixelEditor({ isConnected }: { isConnected: boolean }) {
     const [tool, setTool] = useState<"pencil" | "eraser">("pencil");
     const [isDrawing, setIsDrawing] = useState(false);
     const [loading, setLoading] = useState(false);
-    const canvasRef = useRef<HTMLCanvasElement>(null);
+    const socketRef = useRef<WebSocket | null>(null);
 
     useEffect(() => {
         const newGrid = Array.from({ length: 32 }, () => Array(32).fill("#000000"));
         setGrid(newGrid);
     }, []);
 
+    // Live drawing: every pixel change is streamed to the panel as it happens
+    useEffect(() => {
+        if (!isConnected) return;
+        const socket = api.openFrameSocket();
+        socketRef.current = socket;
+        // The server opens with what the panel shows, as a whole RGB frame
+        socket.onmessage = (event) => {
+            if (!(event.data instanceof ArrayBuffer) || event.data.byteLength !== 32 * 32 * 3) return;
+            const rgb = new Uint8Array(event.data);
+            setGrid(Array.from({ length: 32 }, (_, y) => Array.from({ length: 32 }, (_, x) => {
+                const i = (y * 32 + x) * 3;
+                return "#" + Array.from(rgb.slice(i, i + 3), (v) => v.toString(16).padStart(2, "0")).join("").toUpperCase();
+            })));
+        };
+        return () => {
+            socket.close();
+            socketRef.current = null;
+        };
+    }, [isConnected]);
+
+    const streamFrame = (data: Uint8Array) => {
+        const socket = socketRef.current;
+        if (socket && socket.readyState === WebSocket.OPEN) socket.send(data);
+    };
+
     const handlePixelClick = (rowIndex: number, colIndex: number) => {
         const currentColor = tool === "eraser" ? "#000000" : selectedColor;
         if (grid[rowIndex][colIndex] === currentColor) return;
@@ -34,6 +59,12 @@ export default function PixelEditor({ isConnected }: { isConnected: boolean }) {
         newGrid[rowIndex] = [...newGrid[rowIndex]];
         newGrid[rowIndex][colIndex] = currentColor;
         setGrid(newGrid);
+
+        const hex = currentColor.slice(1);
+        streamFrame(new Uint8Array([
+            colIndex, rowIndex,
+            parseInt(hex.slice(0, 2), 16), parseInt(hex.slice(2, 4), 16), parseInt(hex.slice(4, 6), 16),
+        ]));
     };
 
     const handlePointerDown = (r: number, c: number) => {
@@ -49,34 +80,17 @@ export default function PixelEditor({ isConnected }: { isConnected: boolean }) {
 
     const clearGrid = () => {
         setGrid(Array.from({ length: 32 }, () => Array(32).fill("#000000")));
+        streamFrame(new Uint8Array(32 * 32 * 3));
     };
 
     const handleSendToDevice = async () => {
-        if (!canvasRef.current) return;
         setLoading(true);
 
         try {
-            const ctx = canvasRef.current.getContext("2d");
-            if (!ctx) return;
-
-            ctx.fillStyle = "#000000";
-            ctx.fillRect(0, 0, 32, 32);
-
-            grid.forEach((row, r) => {
-                row.forEach((color, c) => {
-                    ctx.fillStyle = color;
-                    ctx.fillRect(c, r, 1, 1);
-                });
-            });
-
-            const blob = await new Promise<Blob | null>(resolve => canvasRef.current?.toBlob(resolve, 'image/png'));
-            if (!blob) throw new Error("Canvas to Blob failed");
-
-            const file = new File([blob], "drawing.png", { type: "image/png" });
-            await api.upload(file);
-
+            // Only the pixels that changed since the last send go over the air
+            await api.graffiti(grid);
         } catch (error) {
-            console.error("Upload failed", error);
+            console.error("Graffiti send failed", error);
         } finally {
             setLoading(false);
         }
@@ -140,7 +154,6 @@ export default function PixelEditor({ isConnected }: { isConnected: boolean }) {
                             ))
                         ))}
                     </div>
-                    <canvas ref={canvasRef} width={32} height={32} className="hidden" />
                 </div>
 
                 <div className="flex flex-col gap-6 w-full max-w-[250px]">
@@ -47,6 +47,21 @@ export const api = {
     });
     return res.json();
   },
+  graffiti: async (grid: string[][]) => {
+    const res = await fetch(`${API_URL}/graffiti`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ grid }),
+    });
+    return res.json();
+  },
+  // Binary messages: a 3072-byte RGB frame or 5-byte (x, y, r, g, b) pixel deltas.
+  // The server's first message is the current frame; JSON acks follow.
+  openFrameSocket: () => {
+    const socket = new WebSocket(`${API_URL.replace(/^http/, "ws")}/ws/frames`);
+    socket.binaryType = "arraybuffer";
+    return socket;
+  },
   syncTime: async () => {
     const res = await fetch(`${API_URL}/sync-time`, { method: "POST" });
     return res.json();
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Decodes Bluetooth captures of the panel and replays them.
+
+Reads .pcapng files (link type 201, Bluetooth H4 with direction header, as in
+btsnoop/) and Android btsnoop_hci.log files. Captures are memory mapped and
+walked block by block, so big captures are not read into memory. ATT writes
+to the fa02 characteristic are put back together into protocol packets
+(app/utils/protocol.py); chunked GIF and text uploads are reassembled and
+checked against the length and CRC in their headers.
+
+    python tools/capture_replay.py decode btsnoop/redgreenbluea.pcapng
+    python tools/capture_replay.py decode --extract /tmp/uploads btsnoop/*.pcapng
+    python tools/capture_replay.py replay --simulate btsnoop/onoff_and_graffitti.pcapng
+    python tools/capture_replay.py replay --fast --address AA:BB:CC:DD:EE:FF capture.pcapng
+
+replay sends the captured packets to a panel, with the captured timing or, with
+--fast, as fast as the panel acknowledges upload chunks. It prints how long that
+took, so a captured session can be used as a benchmark (see
+backend/benchmarks/run_benchmarks.py).
+"""
+import argparse
+import contextlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "backend"))
+from app.utils import protocol
+
+# One HCI packet: seconds since the epoch (btsnoop: since year 0), True for
+# host to controller, H4 packet (type byte first) as a memoryview into the capture
+Frame = namedtuple("Frame", ["time", "sent", "data"])
+# Typed records produced by decode()
+Packet = namedtuple("Packet", ["time", "data", "decoded"]) # a whole fa02 protocol packet
+Transfer = namedtuple("Transfer", ["time", "end", "opcode", "payload", "crc", "crc_ok", "complete", "chunks"])
+Notification = namedtuple("Notification", ["time", "handle", "data"])
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+LINKTYPE_H4_WITH_PHDR = 201
+BTSNOOP_MAGIC = b"btsnoop\0"
+BTSNOOP_H4 = 1002
+BTSNOOP_EPOCH = 0x00dcddb30f2f8000 # microseconds from year 0 to 1970
+
+H4_ACL = 0x02
+L2CAP_ATT = 0x0004
+ATT_READ_BY_TYPE_RSP = 0x09
+ATT_WRITE_REQ = 0x12
+ATT_PREPARE_WRITE_REQ = 0x16
+ATT_EXECUTE_WRITE_REQ = 0x18
+ATT_NOTIFICATION = 0x1b
+ATT_WRITE_CMD = 0x52
+WRITE_UUID = 0xfa02
+NOTIFY_UUID = 0xfa03
+# Value handles on the panels captured so far, used when the capture has no service discovery
+DEFAULT_HANDLES = {WRITE_UUID: 0x0006, NOTIFY_UUID: 0x0009}
+
+def read_frames(path):
+    """
+    Yields the Frames of a pcapng or btsnoop capture.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        # Not closed explicitly: frames handed out may still point into the mapping,
+        # it goes away with the last of them
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if bytes(view[:8]) == BTSNOOP_MAGIC:
+        yield from _btsnoop_frames(view)
+    else:
+        yield from _pcapng_frames(view)
+
+def _pcapng_frames(view):
+    order = "<"
+    interfaces = [] # (link type, seconds per timestamp unit)
+    offset = 0
+    while offset + 12 <= len(view):
+        block_type, length = struct.unpack_from(order + "II", view, offset)
+        if block_type == PCAPNG_SHB:
+            magic = struct.unpack_from("<I", view, offset + 8)[0]
+            order = "<" if magic == PCAPNG_BYTE_ORDER else ">"
+            length = struct.unpack_from(order + "I", view, offset + 4)[0]
+            interfaces = []
+        if length < 12 or offset + length > len(view):
+            raise Exception(f"Truncated pcapng block at offset {offset}")
+        if block_type == PCAPNG_IDB:
+            link_type = struct.unpack_from(order + "H", view, offset + 8)[0]
+            interfaces.append((link_type, _tsresol(view, order, offset + 16, offset + length - 4)))
+        elif block_type == PCAPNG_EPB:
+            interface, high, low, captured = struct.unpack_from(order + "IIII", view, offset + 8)
+            link_type, resolution = interfaces[interface]
+            if link_type != LINKTYPE_H4_WITH_PHDR:
+                raise Exception(f"Unsupported link type {link_type}, expected {LINKTYPE_H4_WITH_PHDR} (Bluetooth H4 with direction)")
+            data = view[offset + 28:offset + 28 + captured]
+            # The direction header is big endian whatever the section's byte order: 0 sent, 1 received
+            sent = int.from_bytes(data[:4], "big") == 0
+            yield Frame(((high << 32) | low) * resolution, sent, data[4:])
+        offset += length
+
+def _tsresol(view, order, offset, end):
+    # if_tsresol option: 10^-n seconds per unit, or 2^-n with the top bit set; microseconds by default
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(order + "HH", view, offset)
+        if code == 0:
+            break
+        if code == 9:
+            value = view[offset + 4]
+            return 2 ** -(value & 0x7f) if value & 0x80 else 10 ** -value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+def _btsnoop_frames(view):
+    version, datalink = struct.unpack_from(">II", view, 8)
+    if datalink != BTSNOOP_H4:
+        raise Exception(f"Unsupported btsnoop datalink {datalink}, expected {BTSNOOP_H4} (H4)")
+    offset = 16
+    while offset + 24 <= len(view):
+        _, captured, flags, _, timestamp = struct.unpack_from(">IIIIq", view, offset)
+        # flags bit 0: 0 sent, 1 received
+        yield Frame((timestamp - BTSNOOP_EPOCH) / 1e6, not flags & 1, view[offset + 24:offset + 24 + captured])
+        offset += 24 + captured
+
+class AttReader:
+    """
+    Turns HCI frames into ATT events: ('write', time, handle, value),
+    ('notify', time, handle, value) and ('lost', time, None, None) when part of
+    an L2CAP frame is missing from the capture. L2CAP frames split over several
+    ACL packets are put back together, and prepared (long) writes are applied
+    when executed.
+    Characteristic declarations seen in the capture are remembered in uuids.
+    """
+
+    def __init__(self):
+        self._partial = {} # (sent, connection) -> [time, expected length, bytearray]
+        self._prepared = {} # connection -> [(handle, offset, value)]
+        self.uuids = {} # value handle -> 16 bit UUID
+        self.lost_fragments = 0
+
+    def feed(self, frame):
+        data = frame.data
+        if len(data) < 5 or data[0] != H4_ACL:
+            return
+        handle_flags, length = struct.unpack_from("<HH", data, 1)
+        connection, boundary = handle_flags & 0x0fff, (handle_flags >> 12) & 0x3
+        fragment = data[5:5 + length]
+        key = (frame.sent, connection)
+        if boundary == 0x1:
+            partial = self._partial.get(key)
+            if partial is None:
+                # The capture starts, or was filtered, in the middle of an L2CAP frame
+                self.lost_fragments += 1
+                yield ("lost", frame.time, None, None)
+                return
+            started, expected, buffer = partial
+            buffer += fragment
+            if len(buffer) < expected:
+                return
+            del self._partial[key]
+            l2cap = memoryview(buffer)
+        else:
+            if self._partial.pop(key, None) is not None:
+                self.lost_fragments += 1
+                yield ("lost", frame.time, None, None)
+            if len(fragment) < 4:
+                return
+            started, expected = frame.time, struct.unpack_from("<H", fragment)[0] + 4
+            if len(fragment) < expected:
+                self._partial[key] = [started, expected, bytearray(fragment)]
+                return
+            # The common case, one ACL packet: still a view into the capture
+            l2cap = fragment
+        if struct.unpack_from("<H", l2cap, 2)[0] == L2CAP_ATT and expected > 4:
+            yield from self._att(started, frame.sent, connection, l2cap[4:expected])
+
+    def _att(self, when, sent, connection, pdu):
+        opcode = pdu[0]
+        if sent and opcode in (ATT_WRITE_REQ, ATT_WRITE_CMD) and len(pdu) >= 3:
+            yield ("write", when, struct.unpack_from("<H", pdu, 1)[0], pdu[3:])
+        elif sent and opcode == ATT_PREPARE_WRITE_REQ and len(pdu) >= 5:
+            handle, offset = struct.unpack_from("<HH", pdu, 1)
+            self._prepared.setdefault(connection, []).append((handle, offset, bytes(pdu[5:])))
+        elif sent and opcode == ATT_EXECUTE_WRITE_REQ and len(pdu) >= 2:
+            prepared = self._prepared.pop(connection, [])
+            if pdu[1] == 0x01 and prepared:
+                value = bytearray()
+                for handle, offset, part in prepared:
+                    value[offset:offset + len(part)] = part
+                yield ("write", when, prepared[0][0], memoryview(value))
+        elif not sent and opcode == ATT_NOTIFICATION and len(pdu) >= 3:
+            yield ("notify", when, struct.unpack_from("<H", pdu, 1)[0], pdu[3:])
+        elif not sent and opcode == ATT_READ_BY_TYPE_RSP and len(pdu) >= 2 and pdu[1] in (7, 21):
+            # Characteristic declarations: handle, properties, value handle, UUID
+            size = pdu[1]
+            for offset in range(2, len(pdu) - size + 1, size):
+                value_handle = struct.unpack_from("<H", pdu, offset + 3)[0]
+                # 128 bit UUIDs on the Bluetooth base have the 16 bit one at bytes 12-13
+                uuid = struct.unpack_from("<H", pdu, offset + 5 if size == 7 else offset + 17)[0]
+                self.uuids[value_handle] = uuid
+
+    def handle(self, uuid):
+        for value_handle, known in self.uuids.items():
+            if known == uuid:
+                return value_handle
+        return DEFAULT_HANDLES[uuid]
+
+class TransferAssembler:
+    """
+    Collects upload chunks into Transfers, the way the panel does: a first chunk
+    starts a transfer, continuation chunks with the same opcode and CRC extend it,
+    and it is complete once the length in the header has arrived.
+    """
+
+    def __init__(self):
+        self._open = None # [time, opcode, expected, crc, bytearray, chunks]
+
+    def feed(self, when, chunk):
+        if chunk.flag == protocol.FIRST_CHUNK:
+            abandoned = self.flush(when)
+            expected = chunk.total_len - 2 * protocol.UPLOAD_HEADER_SIZE if chunk.opcode == protocol.GIF_UPLOAD else chunk.total_len
+            self._open = [when, chunk.opcode, expected, chunk.crc, bytearray(), 0]
+            if abandoned:
+                yield abandoned
+        elif self._open is None or self._open[1] != chunk.opcode or self._open[3] != chunk.crc:
+            # A continuation whose first chunk is not in the capture
+            return
+        transfer = self._open
+        transfer[4] += chunk.data
+        transfer[5] += 1
+        if len(transfer[4]) >= transfer[2]:
+            self._open = None
+            yield self._finish(when, transfer, True)
+
+    def flush(self, when):
+        # Whatever is still open when the capture ends or another upload starts
+        transfer, self._open = self._open, None
+        return self._finish(when, transfer, False) if transfer else None
+
+    def _finish(self, when, transfer, complete):
+        started, opcode, expected, crc, payload, chunks = transfer
+        payload = bytes(payload)
+        crc_ok = complete and len(payload) == expected and zlib.crc32(payload) == crc
+        return Transfer(started, when, opcode, payload, crc, crc_ok, complete, chunks)
+
+def decode(path, stats=None):
+    """
+    Yields the records of a capture in order: a Packet for every protocol packet
+    written to fa02, a Transfer after the last chunk of every upload (or when it
+    was abandoned) and a Notification for everything the panel sent on fa03.
+    stats, if given, is a dict that gets the counts of what could not be decoded.
+    Captures filtered by value lose the start of long writes; the packet being
+    reassembled is dropped then, and the stream picks up at the next write.
+    """
+    att = AttReader()
+    # Nothing the app sends is longer than an upload chunk
+    reader = protocol.PacketReader(protocol.CHUNK_SIZE + protocol.UPLOAD_HEADER_SIZE)
+    transfers = TransferAssembler()
+    started = 0.0
+    errors = 0
+    dropped = 0
+    longest_write = 0
+    when = 0.0
+    for frame in read_frames(path):
+        for kind, when, handle, value in att.feed(frame):
+            if kind == "lost":
+                # A write we did not see in full: whatever packet was pending has a hole
+                dropped += reader.reset()
+                continue
+            if kind == "notify":
+                if handle == att.handle(NOTIFY_UUID):
+                    yield Notification(when, handle, bytes(value))
+                continue
+            if handle != att.handle(WRITE_UUID):
+                continue
+            if reader.pending and len(value) >= protocol.PREFIX.size and int.from_bytes(value[:2], "little") == len(value):
+                # A write that is exactly one packet while another is still open: the open
+                # one lost its tail (filtered captures do this), start over from here
+                dropped += reader.reset()
+            if not reader.pending:
+                started = when
+            try:
+                packets = reader.feed(value)
+            except Exception:
+                errors += 1
+                continue
+            longest_write = max(longest_write, len(value))
+            if reader.pending and len(value) < longest_write:
+                # Long packets are sliced into full-size writes, only the last one is
+                # shorter; a packet still open after a short write will not be finished
+                dropped += reader.reset()
+            for data in packets:
+                decoded = protocol.decode(data)
+                yield Packet(started, data, decoded)
+                if isinstance(decoded, protocol.UploadChunk):
+                    yield from transfers.feed(when, decoded)
+                started = when
+    abandoned = transfers.flush(when)
+    if abandoned:
+        yield abandoned
+    if stats is not None:
+        stats.update(lost_fragments=att.lost_fragments, bad_packets=errors, dropped_bytes=dropped + reader.pending)
+
+def describe(record, start=0.0):
+    at = f"{record.time - start:9.3f}"
+    if isinstance(record, Notification):
+        return f"{at}  <- {record.data.hex()}"
+    if isinstance(record, Transfer):
+        kind = "GIF" if record.opcode == protocol.GIF_UPLOAD else "text"
+        state = "crc ok" if record.crc_ok else ("CRC MISMATCH" if record.complete else "incomplete")
+        detail = ""
+        if record.opcode == protocol.TEXT_UPLOAD and len(record.payload) >= protocol.TEXT_METADATA_SIZE:
+            detail = f"  {protocol.decode_text_metadata(record.payload)}"
+        return f"{at}  == {kind} upload, {len(record.payload)} bytes in {record.chunks} chunks, crc {record.crc:08x} {state}{detail}"
+    decoded = record.decoded
+    if isinstance(decoded, protocol.UploadChunk):
+        return f"{at}  -> UploadChunk(opcode={decoded.opcode:#04x}, flag={decoded.flag}, total_len={decoded.total_len}, crc={decoded.crc:08x}, {len(decoded.data)} bytes)"
+    if isinstance(decoded, protocol.Unknown):
+        return f"{at}  -> Unknown(opcode={decoded.opcode:#04x}, sub={decoded.sub:#04x}, body={bytes(decoded.body).hex()})"
+    return f"{at}  -> {decoded}"
+
+def extract(record, directory, name):
+    """
+    Writes a reassembled upload to directory; GIFs as .gif, text as .bin.
+    """
+    os.makedirs(directory, exist_ok=True)
+    extension = "gif" if record.opcode == protocol.GIF_UPLOAD else "bin"
+    path = os.path.join(directory, f"{name}_{record.crc:08x}.{extension}")
+    with open(path, "wb") as f:
+        f.write(record.payload)
+    return path
+
+def replay(panel, records, fast=False, speed=1.0):
+    """
+    Writes the Packets among records to panel (a connected IDotMatrix). With
+    fast, upload chunks wait for the panel's ack like the backend does and
+    everything else goes out back to back; otherwise packets keep the captured
+    gaps, divided by speed. Returns a summary dict.
+    """
+    packets = [r for r in records if isinstance(r, Packet)]
+    first = packets[0].time if packets else 0.0
+    started = time.perf_counter()
+    written = 0
+    chunks = 0
+    acked = 0
+    for record in packets:
+        if not fast:
+            delay = (record.time - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        is_chunk = isinstance(record.decoded, protocol.UploadChunk)
+        rtt = panel.send_packet(record.data, wait_for_ack=is_chunk and fast)
+        written += len(record.data)
+        chunks += is_chunk
+        acked += rtt is not None
+    elapsed = time.perf_counter() - started
+    return {
+        "packets": len(packets),
+        "bytes": written,
+        "chunks": chunks,
+        "acked_chunks": acked,
+        "captured_s": round(packets[-1].time - first, 3) if packets else 0.0,
+        "elapsed_s": round(elapsed, 3),
+    }
+
+def connect(address=None, simulate=False):
+    """
+    Returns a connected IDotMatrix: a simulated panel, the panel at address, or
+    the first panel a scan finds.
+    """
+    if simulate:
+        os.environ.setdefault("IDM_SIMULATOR", "1")
+    from app.utils.idotmatrix import IDotMatrix
+    from app.utils.simulator import SimulatedAdapter
+    adapter = SimulatedAdapter(1) if simulate else None
+    panel = IDotMatrix(adapter=adapter)
+    if simulate:
+        address = adapter.panels[0].address()
+    elif address is None:
+        devices = panel.scan_devices()
+        if not devices:
+            raise Exception("No panel found")
+        address = devices[0]["address"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = panel.connect(address)
+    if not panel.is_connected:
+        raise Exception(f"Could not connect to {address}: {result}")
+    return panel
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    decode_cmd = commands.add_parser("decode", help="print the records of captures")
+    decode_cmd.add_argument("captures", nargs="+")
+    decode_cmd.add_argument("--extract", metavar="DIR", help="write reassembled uploads to DIR")
+    decode_cmd.add_argument("--quiet", action="store_true", help="only print transfers and the summary")
+    replay_cmd = commands.add_parser("replay", help="send a capture to a panel")
+    replay_cmd.add_argument("capture")
+    target = replay_cmd.add_mutually_exclusive_group()
+    target.add_argument("--address", help="panel to connect to, default: the first one found")
+    target.add_argument("--simulate", action="store_true", help="replay to a simulated panel")
+    replay_cmd.add_argument("--fast", action="store_true", help="ignore the captured timing")
+    replay_cmd.add_argument("--speed", type=float, default=1.0, help="divide the captured gaps by this")
+    replay_cmd.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    if args.command == "decode":
+        for path in args.captures:
+            extracted = 0
+            print(f"# {path}")
+            stats = {}
+            counts = {"packets": 0, "transfers": 0, "notifications": 0}
+            start = None
+            for record in decode(path, stats):
+                start = record.time if start is None else start
+                if isinstance(record, Transfer):
+                    counts["transfers"] += 1
+                    if args.extract and record.complete:
+                        name = f"{os.path.splitext(os.path.basename(path))[0]}_{extracted:03d}"
+                        print(f"          wrote {extract(record, args.extract, name)}")
+                        extracted += 1
+                elif isinstance(record, Packet):
+                    counts["packets"] += 1
+                else:
+                    counts["notifications"] += 1
+                if not args.quiet or not isinstance(record, Packet):
+                    print(describe(record, start))
+            print(f"# {', '.join(f'{v} {k}' for k, v in {**counts, **stats}.items())}\n")
+        return 0
+
+    records = list(decode(args.capture))
+    panel = connect(args.address, args.simulate)
+    try:
+        summary = replay(panel, records, args.fast, args.speed)
+        if args.simulate:
+            state = panel.peripheral.state()
+            summary.update(airtime_s=round(panel.peripheral.airtime(), 3), transfers=state["transfers"], panel_errors=state["errors"])
+    finally:
+        panel.disconnect()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        for key, value in summary.items():
+            print(f"{key:14} {value}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Checks the glyphs of the native text command (backend/app/utils/fonts.py)
+against the layout the legacy script used before the glyph cache.
+
+That layout centred every character with ImageDraw.textsize, which Pillow 10
+removed. For one character textsize returned (right, bottom) of the ink box
+measured from the drawing origin, i.e. from the ascender line, so every
+character without a descender was drawn with the ascender line on the same
+row. The glyph cache draws the ascender line on one row per font
+(fonts.line_top) and centres each character on its ink horizontally. For
+every character the check moves the old rendering so its baseline lands on
+the new one and requires the same ink on the same rows, ignoring where the
+columns start. Characters wider than the cell are clipped differently by the
+two layouts, for those only the rows holding ink are compared.
+
+    python tools/glyph_layout_check.py ["text" ...]
+
+Exits with 1 when any character differs.
+"""
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "backend"))
+from app.utils.fonts import glyph_cache, font_registry, line_top, GLYPH_MARKER, GLYPH_WIDTH, GLYPH_HEIGHT, GLYPH_FONT_SIZE
+
+# Ascenders, descenders, capitals with accents and punctuation
+DEFAULT_TEXTS = ["Tag.", "Hello, world!", "jolly Äpfel; q?y_"]
+
+def textsize_layout(char, font):
+    """
+    The character as the legacy script drew it: (width, height) from textsize
+    centred in the cell, drawn from the ascender line. Returns (pixels, baseline row).
+    """
+    _, _, width, height = font.getbbox(char)
+    image = Image.new('1', (GLYPH_WIDTH, GLYPH_HEIGHT), 0)
+    draw = ImageDraw.Draw(image)
+    text_x = (GLYPH_WIDTH - width) // 2
+    text_y = (GLYPH_HEIGHT - height) // 2
+    draw.text((text_x, text_y), char, 1, font=font)
+    return np.asarray(image, dtype=bool), text_y + font.getmetrics()[0]
+
+def cached_glyph(char):
+    data = glyph_cache.glyph(char)[len(GLYPH_MARKER):]
+    # Two bytes per row, leftmost pixel in the lowest bit
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder="little")
+    return bits.reshape(GLYPH_HEIGHT, GLYPH_WIDTH).astype(bool)
+
+def ink_columns(pixels):
+    columns = np.flatnonzero(pixels.any(axis=0))
+    return pixels[:, columns[0]:columns[-1] + 1] if len(columns) else pixels[:, :0]
+
+def shift_rows(pixels, rows):
+    # Moves the bitmap down by rows (up when negative); None if ink would fall off
+    shifted = np.zeros_like(pixels)
+    if rows >= 0:
+        if pixels[GLYPH_HEIGHT - rows:].any():
+            return None
+        shifted[rows:] = pixels[:GLYPH_HEIGHT - rows]
+    else:
+        if pixels[:-rows].any():
+            return None
+        shifted[:rows] = pixels[-rows:]
+    return shifted
+
+def main(texts):
+    font = font_registry.get("glyph", GLYPH_FONT_SIZE)
+    ascent = font.getmetrics()[0]
+    baseline = line_top(font) + ascent
+    failures = []
+    old_baselines = {}
+    for char in sorted(set("".join(texts or DEFAULT_TEXTS))):
+        old, old_baseline = textsize_layout(char, font)
+        old_baselines.setdefault(old_baseline, []).append(char)
+        expected = shift_rows(old, baseline - old_baseline)
+        new = cached_glyph(char)
+        if expected is None:
+            failures.append(char)
+        elif font.getbbox(char)[2] - font.getbbox(char)[0] > GLYPH_WIDTH:
+            if not np.array_equal(new.any(axis=1), expected.any(axis=1)):
+                failures.append(char)
+        elif not np.array_equal(ink_columns(new), ink_columns(expected)):
+            failures.append(char)
+
+    checked = sum(len(chars) for chars in old_baselines.values())
+    print(f"{checked} characters checked, baseline on row {baseline - 1}")
+    for row, chars in sorted(old_baselines.items()):
+        print(f"  textsize layout had baseline on row {row - 1} for {''.join(chars)!r}")
+    if failures:
+        print(f"{len(failures)} differ from the textsize layout: {' '.join(repr(c) for c in failures)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
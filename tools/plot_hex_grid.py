@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
-from PIL import Image, ImageDraw, ImageFont
+import os
+import sys
 import zlib
 
+# Glyphs come from the backend's renderer, the one the server sends
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+from app.utils.fonts import glyph_cache, GLYPH_MARKER, GLYPH_WIDTH, GLYPH_HEIGHT
+
 def plot_hex_grid(hex_string, width, height, little_endian=False):
     l = len(hex_string)
     byte_data = bytes.fromhex(hex_string)
@@ -28,69 +33,23 @@ def plot_hex_grid(hex_string, width, height, little_endian=False):
 
 
 def set_text(text, text_colour=(255,0,0), text_colour_effect=0, background_colour=(0,0,0), background_colour_effect=0, speed=50,font_path=None):
-    # Set default font if none provided
-    if font_path is None:
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-    # Adjust font size as needed to fit in 16x32 grid
-    font_size = 24  # This may need tweaking depending on the font and desired appearance
-    font = ImageFont.truetype(font_path, font_size)
+    # One 16 (width) x 32 (height) grid of 0/1 per character, unpacked from the
+    # glyph bitmaps: two bytes per row, leftmost pixel in the lowest bit
+    row_bytes = GLYPH_WIDTH // 8
     bitmaps = []
     for char in text:
-        # Create image with a 16 (width) x 32 (height) grid
-        image = Image.new('1', (16, 32), 0) # Background is black 0 - could be changed to 1 for white for inverted text
-        draw = ImageDraw.Draw(image)
-        # Calculate text position to center it in the grid
-        text_width, text_height = draw.textsize(char, font=font)
-        text_x = (16 - text_width) // 2
-        text_y = (32 - text_height) // 2
-        # Draw the character
-        draw.text((text_x, text_y), char, 1, font=font) # 1 for white text
-        # Convert to bitmap and add to list
-        bitmap = image.load()
-        bitmaps.append([[bitmap[x, y] for x in range(16)] for y in range(32)])
-        print(bitmaps)
+        glyph = glyph_cache.glyph(char, font_path or "glyph")[len(GLYPH_MARKER):]
+        bitmaps.append([
+            [(glyph[y * row_bytes + x // 8] >> (x % 8)) & 1 for x in range(GLYPH_WIDTH)]
+            for y in range(GLYPH_HEIGHT)
+        ])
     return bitmaps
 
-def string_to_bitmaps(input_string, font_path=None):
-    if font_path is None:
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-
-    font_size = 24
-    font = ImageFont.truetype(font_path, font_size)
-
-    hex_strings = []
-
-    for char in input_string:
-        image = Image.new('1', (16, 32), 0)
-        draw = ImageDraw.Draw(image)
-
-        text_width, text_height = draw.textsize(char, font=font)
-        text_x = (16 - text_width) // 2
-        text_y = (32 - text_height) // 2
-
-        draw.text((text_x, text_y), char, 1, font=font)
+def char_hex(char, font_path=None):
+    return glyph_cache.glyph(char, font_path or "glyph").hex()
 
-        bitmap = image.load()
-        byte = 0
-        bit_count = 0
-        hex_string = ""
-        hex_string+= "05ffffff"
-
-
-        for y in range(32):
-            for x in range(16):
-                # Accumulate bits in little-endian order
-                byte |= (bitmap[x, y] << bit_count)
-                bit_count += 1
-
-                if bit_count == 8 or (x == 15 and y == 31):
-                    hex_string += '{:02x}'.format(byte)
-                    byte = 0
-                    bit_count = 0
-
-        hex_strings.append(hex_string)
-
-    return hex_strings
+def string_to_bitmaps(input_string, font_path=None):
+    return [char_hex(char, font_path) for char in input_string]
 
 def iterate_values(hex_string):
     # Convert hex string to bytes
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Checks backend/app/utils/protocol.py against the captures in btsnoop/.
+
+Every write in the *.txt value dumps that is a whole packet is decoded and
+encoded again, and has to come back byte for byte. Complete upload packets are
+also rebuilt from their payload with protocol.Upload, which checks the length,
+total and CRC fields the encoder computes. Lines that are only part of a packet
+(the dumps cut long writes) are counted and skipped.
+
+    python tools/protocol_roundtrip.py [capture.txt ...]
+
+Exits with 1 when anything does not round-trip.
+"""
+import collections
+import glob
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "backend"))
+from app.utils import protocol
+
+def capture_packets(path):
+    """
+    Yields (line number, bytes) for every write in a value dump. Lines with
+    several comma separated values are reads of the GATT table, not writes.
+    """
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or "," in line:
+                continue
+            yield number, bytes.fromhex(line)
+
+def check(packet):
+    """
+    Returns (packet type name, None) or (name, what went wrong).
+    """
+    decoded = protocol.decode(packet)
+    name = type(decoded).__name__
+    if isinstance(decoded, protocol.Unknown):
+        name = f"Unknown {decoded.opcode:02x}/{decoded.sub:02x}"
+    encoded = protocol.encode(decoded)
+    if encoded != packet:
+        return name, f"re-encoded as {encoded.hex()}"
+    if isinstance(decoded, protocol.UploadChunk) and decoded.flag == protocol.FIRST_CHUNK:
+        payload = bytes(decoded.data)
+        upload = protocol.Upload(decoded.opcode, payload)
+        if decoded.total_len == upload.total_len:
+            # A whole upload in one packet: everything in the header can be recomputed
+            if upload.crc != decoded.crc:
+                return name, f"CRC {decoded.crc:08x}, payload has {upload.crc:08x}"
+            if bytes(upload.packets[0]) != packet:
+                return name, f"rebuilt as {bytes(upload.packets[0]).hex()}"
+    return name, None
+
+def main(paths):
+    paths = paths or sorted(glob.glob(os.path.join(REPO_DIR, "btsnoop", "*.txt")))
+    counts = collections.Counter()
+    fragments = 0
+    failures = []
+    for path in paths:
+        for number, packet in capture_packets(path):
+            if len(packet) < protocol.PREFIX.size or int.from_bytes(packet[:2], "little") != len(packet):
+                # CCCD writes (0100) and pieces of long writes
+                fragments += 1
+                continue
+            name, problem = check(packet)
+            counts[name] += 1
+            if problem:
+                failures.append(f"{os.path.basename(path)}:{number} {name}: {problem}")
+
+    for name, count in sorted(counts.items()):
+        print(f"{name:24} {count}")
+    print(f"\n{sum(counts.values())} packets checked, {fragments} partial writes skipped")
+    if failures:
+        print(f"\n{len(failures)} did not round-trip:")
+        for line in failures:
+            print(f"  {line}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))